@@ -4,12 +4,36 @@ from trytond.pool import Pool
 from .account import *
 from .liquidation import *
 from .move import *
+from .company import *
+from .liquidation_import import *
+from .ats import *
+from .post_queue import *
+from .profiling import *
 
 def register():
     Pool.register(
         FiscalYear,
         Period,
+        Tax,
+        Journal,
+        Company,
         Move,
+        Reconciliation,
         AccountLiquidation,
         AccountLiquidationTax,
+        LiquidationImportCheckpoint,
+        LiquidationImportStart,
+        LiquidationATS,
+        LiquidationATSLine,
+        LiquidationATSExportStart,
+        LiquidationATSExportResult,
+        LiquidationPostQueue,
+        LiquidationProfile,
         module='nodux_account_purchase_settlement', type_='model')
+    Pool.register(
+        LiquidationImport,
+        LiquidationATSExport,
+        module='nodux_account_purchase_settlement', type_='wizard')
+    Pool.register(
+        LiquidationReport,
+        module='nodux_account_purchase_settlement', type_='report')
@@ -1,13 +1,80 @@
 #This file is part of Tryton.  The COPYRIGHT file at the top level of
 #this repository contains the full copyright notices and license terms.
+from bisect import bisect_right
+from weakref import WeakKeyDictionary
 from trytond.model import ModelSQL, ModelView, MatchMixin, fields
 from trytond.pyson import Eval
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
+from sql import Null
+from sql.operators import Or
+from . import profiling
 
-__all__ = ['FiscalYear', 'Period']
+__all__ = ['FiscalYear', 'Period', 'Tax', 'Journal']
 __metaclass__ = PoolMeta
 
+_SEQUENCES = ('out_invoice_sequence', 'in_invoice_sequence',
+    'out_credit_note_sequence', 'in_credit_note_sequence',
+    'out_withholding_sequence', 'out_liquidation_sequence')
+
+# Caches of each transaction, dropped with its cursor
+_transaction_caches = WeakKeyDictionary()
+
+
+def _transaction_cache(name):
+    '''
+    Return the cache dictionary name of the current transaction
+
+    Unlike trytond Cache, nothing found in a transaction which is rolled
+    back can be served to the others.
+    '''
+    caches = _transaction_caches.setdefault(Transaction().cursor, {})
+    return caches.setdefault(name, {})
+
+
+def _get_numbered_record(records, values):
+    '''
+    Return the first of records (fiscal years or periods) that has numbered
+    invoices or liquidations in its dates for a sequence changed by values
+    '''
+    pool = Pool()
+    Invoice = pool.get('account.invoice')
+    Liquidation = pool.get('account.liquidation')
+    cursor = Transaction().cursor
+
+    changes = []
+    for name in _SEQUENCES:
+        if not values.get(name):
+            continue
+        for record in records:
+            sequence = getattr(record, name)
+            if sequence and sequence.id != values[name]:
+                changes.append((record, name[:-9]))
+    liquidation_types = set(t for t, _ in Liquidation.type.selection)
+
+    for Model, date_name, types in (
+            (Invoice, 'invoice_date', lambda t: t not in liquidation_types),
+            (Liquidation, 'liquidation_date', lambda t: t in liquidation_types),
+            ):
+        model_changes = [(r, t) for r, t in changes if types(t)]
+        if not model_changes:
+            continue
+        table = Model.__table__()
+        date = getattr(table, date_name)
+        cursor.execute(*table.select(table.type, date,
+                where=(table.number != Null)
+                & Or([(table.type == t)
+                        & (date >= r.start_date) & (date <= r.end_date)
+                        for r, t in model_changes]),
+                limit=1))
+        row = cursor.fetchone()
+        if row:
+            type_, date_ = row
+            for record, record_type in model_changes:
+                if (record_type == type_
+                        and record.start_date <= date_ <= record.end_date):
+                    return record
+
 class FiscalYear:
     __name__ = 'account.fiscalyear'
 
@@ -27,46 +94,62 @@ class FiscalYear:
         depends=['company'])
 
 
+    @classmethod
+    def validate(cls, fiscalyears):
+        with Transaction().set_context(_check_invoice_sequences=False):
+            super(FiscalYear, cls).validate(fiscalyears)
+        cls._check_invoice_sequences(fiscalyears)
+
     def check_invoice_sequences(self):
-        for sequence in ('out_invoice_sequence', 'in_invoice_sequence',
-                'out_credit_note_sequence', 'in_credit_note_sequence',
-                'out_withholding_sequence', 'out_liquidation_sequence'):
-            fiscalyears = self.search([
-                    (sequence, '=', getattr(self, sequence).id),
-                    ('id', '!=', self.id),
-                    ])
-            if fiscalyears:
-                self.raise_user_error('different_invoice_sequence', {
-                        'first': self.rec_name,
-                        'second': fiscalyears[0].rec_name,
-                        })
+        if Transaction().context.get('_check_invoice_sequences', True):
+            self._check_invoice_sequences([self])
 
     @classmethod
-    def write(cls, *args):
-        Invoice = Pool().get('account.invoice')
+    def _check_invoice_sequences(cls, fiscalyears):
+        '''
+        Check with one query that the sequences of the fiscal years are not
+        used by other fiscal years
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        used = {}
+        for fiscalyear in fiscalyears:
+            for name in _SEQUENCES:
+                sequence = getattr(fiscalyear, name)
+                if sequence:
+                    used[(name, sequence.id)] = fiscalyear
+        if not used:
+            return
+        sequence_ids = list(set(i for _, i in used))
+        columns = [getattr(table, n) for n in _SEQUENCES]
+        cursor.execute(*table.select(table.id, *columns,
+                where=Or([c.in_(sequence_ids) for c in columns])))
+        for row in cursor.fetchall():
+            fiscalyear_id = row[0]
+            for name, sequence_id in zip(_SEQUENCES, row[1:]):
+                fiscalyear = used.get((name, sequence_id))
+                if fiscalyear and fiscalyear.id != fiscalyear_id:
+                    cls.raise_user_error('different_invoice_sequence', {
+                            'first': fiscalyear.rec_name,
+                            'second': cls(fiscalyear_id).rec_name,
+                            })
 
+    @classmethod
+    def write(cls, *args):
         actions = iter(args)
         for fiscalyears, values in zip(actions, actions):
-            for sequence in ('out_invoice_sequence', 'in_invoice_sequence',
-                    'out_credit_note_sequence', 'in_credit_note_sequence',
-                    'out_withholding_sequence', 'out_liquidation_sequence'):
-                    if not values.get(sequence):
-                        continue
-                    for fiscalyear in fiscalyears:
-                        if (getattr(fiscalyear, sequence)
-                                and (getattr(fiscalyear, sequence).id !=
-                                    values[sequence])):
-                            if Invoice.search([
-                                        ('invoice_date', '>=',
-                                            fiscalyear.start_date),
-                                        ('invoice_date', '<=',
-                                            fiscalyear.end_date),
-                                        ('number', '!=', None),
-                                        ('type', '=', sequence[:-9]),
-                                        ]):
-                                cls.raise_user_error('change_invoice_sequence',
-                                    (fiscalyear.rec_name,))
+            fiscalyear = _get_numbered_record(fiscalyears, values)
+            if fiscalyear:
+                cls.raise_user_error('change_invoice_sequence',
+                    (fiscalyear.rec_name,))
         super(FiscalYear, cls).write(*args)
+        Pool().get('account.period').clear_liquidation_cache()
+
+    @classmethod
+    def delete(cls, fiscalyears):
+        super(FiscalYear, cls).delete(fiscalyears)
+        Pool().get('account.period').clear_liquidation_cache()
 
 class Period:
     __name__ = 'account.period'
@@ -80,35 +163,59 @@ class Period:
             },
         depends=['type'])
 
-
     @classmethod
     def validate(cls, periods):
-        super(Period, cls).validate(periods)
-        for period in periods:
-            period.check_invoice_sequences()
+        with Transaction().set_context(_check_invoice_sequences=False):
+            super(Period, cls).validate(periods)
+        cls._check_invoice_sequences(periods)
 
     def check_invoice_sequences(self):
-        for sequence_name in ('out_invoice_sequence', 'in_invoice_sequence',
-                'out_credit_note_sequence', 'in_credit_note_sequence',
-                'out_withholding_sequence', 'out_liquidation_sequence'):
-            sequence = getattr(self, sequence_name)
-            if not sequence:
-                continue
-            periods = self.search([
-                    (sequence_name, '=', sequence.id),
-                    ('fiscalyear', '!=', self.fiscalyear.id),
-                    ])
-            if periods:
-                self.raise_user_error('different_invoice_sequence', {
-                        'first': self.rec_name,
-                        'second': periods[0].rec_name,
-                        })
-            if (sequence.company
-                    and sequence.company != self.fiscalyear.company):
-                self.raise_user_error('different_period_fiscalyear_company', {
-                        'period': self.rec_name,
-                        'fiscalyear': self.fiscalyear.rec_name,
-                        })
+        if Transaction().context.get('_check_invoice_sequences', True):
+            self._check_invoice_sequences([self])
+
+    @classmethod
+    def _check_invoice_sequences(cls, periods):
+        '''
+        Check with one query that the sequences of the periods are not used
+        by periods of other fiscal years and belong to their company
+        '''
+        Sequence = Pool().get('ir.sequence.strict')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        used = {}
+        for period in periods:
+            for name in _SEQUENCES:
+                sequence = getattr(period, name)
+                if sequence:
+                    used.setdefault((name, sequence.id), []).append(period)
+        if not used:
+            return
+        sequence_ids = list(set(i for _, i in used))
+        columns = [getattr(table, n) for n in _SEQUENCES]
+        cursor.execute(*table.select(table.id, table.fiscalyear, *columns,
+                where=Or([c.in_(sequence_ids) for c in columns])))
+        for row in cursor.fetchall():
+            period_id, fiscalyear_id = row[:2]
+            for name, sequence_id in zip(_SEQUENCES, row[2:]):
+                for period in used.get((name, sequence_id), []):
+                    if period.fiscalyear.id != fiscalyear_id:
+                        cls.raise_user_error('different_invoice_sequence', {
+                                'first': period.rec_name,
+                                'second': cls(period_id).rec_name,
+                                })
+
+        companies = dict((s.id, s.company)
+            for s in Sequence.browse(sequence_ids))
+        for (name, sequence_id), sequence_periods in used.items():
+            company = companies[sequence_id]
+            for period in sequence_periods:
+                if company and company != period.fiscalyear.company:
+                    cls.raise_user_error(
+                        'different_period_fiscalyear_company', {
+                            'period': period.rec_name,
+                            'fiscalyear': period.fiscalyear.rec_name,
+                            })
 
     @classmethod
     def create(cls, vlist):
@@ -117,39 +224,109 @@ class Period:
         for vals in vlist:
             if vals.get('fiscalyear'):
                 fiscalyear = FiscalYear(vals['fiscalyear'])
-                for sequence in ('out_invoice_sequence', 'in_invoice_sequence',
-                        'out_credit_note_sequence', 'in_credit_note_sequence',
-                        'out_withholding_sequence', 'out_liquidation_sequence'):
+                for sequence in _SEQUENCES:
                     if not vals.get(sequence):
                         vals[sequence] = getattr(fiscalyear, sequence).id
-        return super(Period, cls).create(vlist)
+        periods = super(Period, cls).create(vlist)
+        cls.clear_liquidation_cache()
+        return periods
 
     @classmethod
     def write(cls, *args):
-        Invoice = Pool().get('account.invoice')
         actions = iter(args)
         for periods, values in zip(actions, actions):
-            for sequence_name in ('out_invoice_sequence',
-                    'in_invoice_sequence', 'out_credit_note_sequence',
-                    'in_credit_note_sequence','out_withholding_sequence',
-                    'out_liquidation_sequence'):
-                if not values.get(sequence_name):
-                    continue
-                for period in periods:
-                    sequence = getattr(period, sequence_name)
-                    if (sequence and sequence.id != values[sequence_name]):
-                        if Invoice.search([
-                                    ('invoice_date', '>=', period.start_date),
-                                    ('invoice_date', '<=', period.end_date),
-                                    ('number', '!=', None),
-                                    ('type', '=', sequence_name[:-9]),
-                                    ]):
-                            cls.raise_user_error('change_invoice_sequence',
-                                (period.rec_name,))
+            period = _get_numbered_record(periods, values)
+            if period:
+                cls.raise_user_error('change_invoice_sequence',
+                    (period.rec_name,))
         super(Period, cls).write(*args)
+        cls.clear_liquidation_cache()
+
+    @classmethod
+    def delete(cls, periods):
+        super(Period, cls).delete(periods)
+        cls.clear_liquidation_cache()
+
+    @classmethod
+    def clear_liquidation_cache(cls):
+        _transaction_cache('account_period.find_cached').clear()
+        _transaction_cache('account_period.get_invoice_sequence').clear()
+
+    @classmethod
+    def find_cached(cls, company_id, date, test_state=True):
+        '''
+        Return the period id for the company and date like find but keep
+        the date ranges of the periods already found in the transaction.
+        '''
+        Date = Pool().get('ir.date')
+        cache = _transaction_cache('account_period.find_cached')
+        if not date:
+            date = Date.today()
+        key = (company_id, test_state)
+        ranges = cache.get(key) or ()
+        index = bisect_right([r[0] for r in ranges], date) - 1
+        if index >= 0:
+            start_date, end_date, period_id = ranges[index]
+            if date <= end_date:
+                return period_id
+        with profiling.stage('period.find'):
+            period_id = cls.find(company_id, date=date, test_state=test_state)
+        period = cls(period_id)
+        ranges = tuple(sorted(ranges
+                + ((period.start_date, period.end_date, period.id),)))
+        cache[key] = ranges
+        return period_id
 
     def get_invoice_sequence(self, invoice_type):
-        sequence = getattr(self, invoice_type + '_sequence')
-        if sequence:
-            return sequence
-        return getattr(self.fiscalyear, invoice_type + '_sequence')
+        Sequence = Pool().get('ir.sequence.strict')
+        cache = _transaction_cache('account_period.get_invoice_sequence')
+        key = (self.id, invoice_type)
+        sequence_id = cache.get(key, -1)
+        if sequence_id == -1:
+            sequence = getattr(self, invoice_type + '_sequence')
+            if not sequence:
+                sequence = getattr(self.fiscalyear, invoice_type + '_sequence')
+            sequence_id = sequence.id if sequence else None
+            cache[key] = sequence_id
+        if sequence_id is not None:
+            return Sequence(sequence_id)
+
+
+class Tax:
+    __name__ = 'account.tax'
+
+    @classmethod
+    def create(cls, vlist):
+        taxes = super(Tax, cls).create(vlist)
+        Pool().get('account.liquidation.tax').clear_tax_cache()
+        return taxes
+
+    @classmethod
+    def write(cls, *args):
+        super(Tax, cls).write(*args)
+        Pool().get('account.liquidation.tax').clear_tax_cache()
+
+    @classmethod
+    def delete(cls, taxes):
+        super(Tax, cls).delete(taxes)
+        Pool().get('account.liquidation.tax').clear_tax_cache()
+
+
+class Journal:
+    __name__ = 'account.journal'
+
+    @classmethod
+    def create(cls, vlist):
+        journals = super(Journal, cls).create(vlist)
+        Pool().get('account.liquidation').clear_defaults_cache()
+        return journals
+
+    @classmethod
+    def write(cls, *args):
+        super(Journal, cls).write(*args)
+        Pool().get('account.liquidation').clear_defaults_cache()
+
+    @classmethod
+    def delete(cls, journals):
+        super(Journal, cls).delete(journals)
+        Pool().get('account.liquidation').clear_defaults_cache()
@@ -0,0 +1,333 @@
+#This file is part of the nodux_account_purchase_settlement module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+import csv
+import io
+import datetime
+from decimal import Decimal
+from xml.sax.saxutils import quoteattr
+
+from sql import Null
+from sql.aggregate import Count, Sum
+from sql.conditionals import Coalesce
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+from trytond.pool import Pool
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
+
+from .liquidation import RateCache
+
+__all__ = ['LiquidationATS', 'LiquidationATSLine', 'LiquidationATSExportStart',
+    'LiquidationATSExportResult', 'LiquidationATSExport']
+
+
+class LiquidationATS(ModelSQL, ModelView):
+    'Purchase Liquidation ATS Summary'
+    __name__ = 'account.liquidation.ats'
+    _rec_name = 'period'
+    period = fields.Many2One('account.period', 'Period', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    refresh_date = fields.Timestamp('Refresh Date', readonly=True)
+    lines = fields.One2Many('account.liquidation.ats.line', 'summary',
+        'Lines', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(LiquidationATS, cls).__setup__()
+        cls._sql_constraints += [
+            ('period_uniq', 'UNIQUE(period)',
+                'Only one ATS summary is allowed per period.'),
+            ]
+
+    @classmethod
+    def get(cls, period):
+        summaries = cls.search([('period', '=', period.id)], limit=1)
+        if summaries:
+            return summaries[0]
+        summary, = cls.create([{'period': period.id}])
+        return summary
+
+    @classmethod
+    def _get_query(cls, liquidation_ids):
+        '''
+        Return the query that sums the tax lines of the liquidation ids per
+        currency and date of the liquidations
+        '''
+        pool = Pool()
+        Liquidation = pool.get('account.liquidation')
+        LiquidationTax = pool.get('account.liquidation.tax')
+        liquidation = Liquidation.__table__()
+        tax = LiquidationTax.__table__()
+        return tax.join(liquidation,
+            condition=tax.liquidation == liquidation.id
+            ).select(tax.tipo, tax.tax_code, tax.base_code,
+            liquidation.currency, liquidation.liquidation_date,
+            Coalesce(Sum(tax.base), 0), Coalesce(Sum(tax.amount), 0),
+            Count(tax.id),
+            where=reduce_ids(tax.liquidation, liquidation_ids),
+            group_by=[tax.tipo, tax.tax_code, tax.base_code,
+                liquidation.currency, liquidation.liquidation_date])
+
+    def _get_changes(self):
+        '''
+        Return the ids of the liquidations to add to the summary and of
+        those to remove from it
+
+        The liquidations to add are the posted ones of the period not yet
+        summarized and those to remove are the summarized ones which are
+        no longer posted.
+        '''
+        pool = Pool()
+        Liquidation = pool.get('account.liquidation')
+        Move = pool.get('account.move')
+        cursor = Transaction().cursor
+        liquidation = Liquidation.__table__()
+        move = Move.__table__()
+
+        cursor.execute(*liquidation.join(move,
+                condition=liquidation.move == move.id
+                ).select(liquidation.id,
+                where=(liquidation.state == 'posted')
+                & (move.period == self.period.id)
+                & (liquidation.ats_summary == Null)))
+        added = [i for i, in cursor.fetchall()]
+        cursor.execute(*liquidation.select(liquidation.id,
+                where=(liquidation.ats_summary == self.id)
+                & (liquidation.state != 'posted')))
+        removed = [i for i, in cursor.fetchall()]
+        return added, removed
+
+    @classmethod
+    def _mark(cls, liquidation_ids, summary_id):
+        '''
+        Set the summary of the liquidations without changing their
+        write_date which validates the report cache
+        '''
+        Liquidation = Pool().get('account.liquidation')
+        cursor = Transaction().cursor
+        liquidation = Liquidation.__table__()
+        for sub_ids in grouped_slice(liquidation_ids):
+            cursor.execute(*liquidation.update(
+                    columns=[liquidation.ats_summary],
+                    values=[summary_id],
+                    where=reduce_ids(liquidation.id, sub_ids)))
+
+    @classmethod
+    def refresh(cls, summaries, incremental=True):
+        '''
+        Add the liquidations posted and remove those cancelled since the
+        last refresh or aggregate all of them if not incremental
+
+        The summarized liquidations are marked so a liquidation is counted
+        once whenever its move was created or its transaction committed.
+        The amounts are converted to the company currency at the date of
+        each liquidation.
+        '''
+        pool = Pool()
+        Line = pool.get('account.liquidation.ats.line')
+        Liquidation = pool.get('account.liquidation')
+        Currency = pool.get('currency.currency')
+        cursor = Transaction().cursor
+        liquidation = Liquidation.__table__()
+        now = datetime.datetime.now()
+        rates = RateCache()
+        currencies = {}
+
+        for summary in summaries:
+            company_currency = summary.period.company.currency
+            if not incremental:
+                Line.delete(list(summary.lines))
+                cursor.execute(*liquidation.update(
+                        columns=[liquidation.ats_summary],
+                        values=[Null],
+                        where=liquidation.ats_summary == summary.id))
+                lines = {}
+            else:
+                lines = dict(((l.tipo, l.tax_code.id if l.tax_code else None,
+                                l.base_code.id if l.base_code else None), l)
+                    for l in summary.lines)
+
+            added, removed = summary._get_changes()
+            changes = {}
+            for ids, sign in ((added, 1), (removed, -1)):
+                for sub_ids in grouped_slice(ids):
+                    cursor.execute(*cls._get_query(sub_ids))
+                    for (tipo, tax_code, base_code, currency_id, date, base,
+                            amount, count) in cursor.fetchall():
+                        if currency_id not in currencies:
+                            currencies[currency_id] = Currency(currency_id)
+                        currency = currencies[currency_id]
+                        # SQLite returns the date as string
+                        if isinstance(date, basestring):
+                            date = datetime.datetime.strptime(date,
+                                '%Y-%m-%d').date()
+                        # SQLite uses float for SUM
+                        base = rates.compute(currency, Decimal(str(base)),
+                            company_currency, date)
+                        amount = rates.compute(currency,
+                            Decimal(str(amount)), company_currency, date)
+                        change = changes.setdefault(
+                            (tipo, tax_code, base_code), [0, 0, 0])
+                        change[0] += sign * base
+                        change[1] += sign * amount
+                        change[2] += sign * count
+            cls._mark(added, summary.id)
+            cls._mark(removed, None)
+
+            to_create = []
+            to_write = []
+            to_delete = []
+            for key, (base, amount, count) in changes.items():
+                line = lines.get(key)
+                if line:
+                    count += line.count
+                    if not count:
+                        to_delete.append(line)
+                        continue
+                    to_write.extend(([line], {
+                                'base': line.base + base,
+                                'amount': line.amount + amount,
+                                'count': count,
+                                }))
+                elif count:
+                    tipo, tax_code, base_code = key
+                    to_create.append({
+                            'summary': summary.id,
+                            'tipo': tipo,
+                            'tax_code': tax_code,
+                            'base_code': base_code,
+                            'base': base,
+                            'amount': amount,
+                            'count': count,
+                            })
+            if to_create:
+                Line.create(to_create)
+            if to_write:
+                Line.write(*to_write)
+            if to_delete:
+                Line.delete(to_delete)
+            cls.write([summary], {'refresh_date': now})
+
+    def iter_csv(self):
+        '''
+        Yield the summary as CSV lines
+        '''
+        output = io.BytesIO()
+        writer = csv.writer(output)
+        for row in [('tipo', 'base_code', 'tax_code', 'base', 'amount',
+                    'count')] + [l.get_row() for l in self.lines]:
+            writer.writerow([unicode(v).encode('utf-8') for v in row])
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+
+    def iter_xml(self):
+        '''
+        Yield the summary as XML lines
+        '''
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield '<ats periodo=%s>\n' % quoteattr(
+            self.period.rec_name.encode('utf-8'))
+        for tipo, base_code, tax_code, base, amount, count in (
+                l.get_row() for l in self.lines):
+            yield ('  <retencion tipo=%s codigoBase=%s codigoImpuesto=%s '
+                'base="%s" valor="%s" lineas="%s"/>\n') % (
+                quoteattr(tipo.encode('utf-8')),
+                quoteattr(base_code.encode('utf-8')),
+                quoteattr(tax_code.encode('utf-8')),
+                base, amount, count)
+        yield '</ats>\n'
+
+
+class LiquidationATSLine(ModelSQL, ModelView):
+    'Purchase Liquidation ATS Summary Line'
+    __name__ = 'account.liquidation.ats.line'
+    summary = fields.Many2One('account.liquidation.ats', 'Summary',
+        required=True, readonly=True, select=True, ondelete='CASCADE')
+    tipo = fields.Char('Tipo de retencion', readonly=True)
+    base_code = fields.Many2One('account.tax.code', 'Base Code',
+        readonly=True)
+    tax_code = fields.Many2One('account.tax.code', 'Tax Code', readonly=True)
+    base = fields.Numeric('Base', digits=(16, 2), readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+    count = fields.Integer('Lines', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(LiquidationATSLine, cls).__setup__()
+        cls._order.insert(0, ('tipo', 'ASC'))
+
+    def get_row(self):
+        return (self.tipo or '',
+            (self.base_code.code if self.base_code else None) or '',
+            (self.tax_code.code if self.tax_code else None) or '',
+            self.base, self.amount, self.count)
+
+
+class LiquidationATSExportStart(ModelView):
+    'Purchase Liquidation ATS Export Start'
+    __name__ = 'account.liquidation.ats.export.start'
+    period = fields.Many2One('account.period', 'Period', required=True,
+        domain=[('type', '=', 'standard')])
+    format_ = fields.Selection([
+            ('xml', 'XML'),
+            ('csv', 'CSV'),
+            ], 'Format', required=True)
+    incremental = fields.Boolean('Incremental',
+        help='Only add the liquidations posted and remove those cancelled '
+        'since the last export.')
+
+    @staticmethod
+    def default_format_():
+        return 'xml'
+
+    @staticmethod
+    def default_incremental():
+        return True
+
+
+class LiquidationATSExportResult(ModelView):
+    'Purchase Liquidation ATS Export Result'
+    __name__ = 'account.liquidation.ats.export.result'
+    file_ = fields.Binary('File', readonly=True, filename='filename')
+    filename = fields.Char('File Name', readonly=True)
+
+
+class LiquidationATSExport(Wizard):
+    'Purchase Liquidation ATS Export'
+    __name__ = 'account.liquidation.ats.export'
+    start = StateView('account.liquidation.ats.export.start',
+        'nodux_account_purchase_settlement.ats_export_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Export', 'export', 'tryton-ok', default=True),
+            ])
+    export = StateTransition()
+    result = StateView('account.liquidation.ats.export.result',
+        'nodux_account_purchase_settlement.ats_export_result_view_form', [
+            Button('Close', 'end', 'tryton-close'),
+            ])
+
+    def transition_export(self):
+        ATS = Pool().get('account.liquidation.ats')
+        summary = ATS.get(self.start.period)
+        ATS.refresh([summary], incremental=self.start.incremental)
+        summary = ATS(summary.id)
+        if self.start.format_ == 'csv':
+            lines = summary.iter_csv()
+        else:
+            lines = summary.iter_xml()
+        output = io.BytesIO()
+        for line in lines:
+            output.write(line)
+        self.result.file_ = buffer(output.getvalue())
+        self.result.filename = 'ats-%s.%s' % (summary.period.rec_name,
+            self.start.format_)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'file_': self.result.file_,
+            'filename': self.result.filename,
+            }
@@ -0,0 +1,529 @@
+#This file is part of the nodux_account_purchase_settlement module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''
+Benchmark the purchase liquidations on a test database.
+
+Synthetic companies with their chart, fiscal year, parties and taxes are
+created, then liquidations are added until each of the requested sizes is
+reached. At each size, the create throughput, the get_amount latency, the
+search on total_amount within a date range, the post throughput, the
+onchange latency and the tree view load time are measured and the query
+plans of the list, amount search, move line join and tax line reads are
+reported so index changes can be compared. The data are committed so the
+database must be a throwaway one where the module is installed. The
+generation is seeded so runs of different commits against fresh databases
+are comparable.
+
+Usage:
+    python -m trytond.modules.nodux_account_purchase_settlement.benchmark \\
+        -c trytond.conf -d database [-u admin] [--sizes 1000,10000] \\
+        [--companies 1] [--taxes 2] [--post 1000] [-o result.json]
+'''
+import argparse
+import datetime
+import json
+import logging
+import random
+import sys
+import time
+from decimal import Decimal
+
+from sql.aggregate import Sum
+
+from trytond import backend
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from .account import _SEQUENCES
+from .liquidation_import import chunked
+from .posting import PENDING_DOMAIN, init_pool
+
+logger = logging.getLogger(__name__)
+
+_CHUNK = 1000
+
+
+def _timed(func, *args, **kwargs):
+    '''
+    Return the seconds taken by func and its result
+    '''
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def _latencies(seconds):
+    seconds = sorted(seconds)
+    if not seconds:
+        return {}
+    return {
+        'calls': len(seconds),
+        'mean': sum(seconds) / len(seconds),
+        'p50': seconds[len(seconds) // 2],
+        'p95': seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))],
+        'max': seconds[-1],
+        }
+
+
+class Fixture(object):
+    '''
+    The records of a synthetic company
+    '''
+
+    def __init__(self, name, rng, parties, taxes):
+        self.name = name
+        self.rng = rng
+        self.party_count = parties
+        self.tax_count = taxes
+
+    def setup(self):
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Party = pool.get('party.party')
+        Company = pool.get('company.company')
+        User = pool.get('res.user')
+
+        currencies = Currency.search([('code', '=', 'USD')], limit=1)
+        if currencies:
+            currency, = currencies
+        else:
+            currency, = Currency.create([{
+                        'name': 'US Dollar',
+                        'code': 'USD',
+                        'symbol': '$',
+                        'rounding': Decimal('0.01'),
+                        'digits': 2,
+                        }])
+        party, = Party.create([{'name': self.name}])
+        self.company, = Company.create([{
+                    'party': party.id,
+                    'currency': currency.id,
+                    }])
+        user = User(Transaction().user)
+        User.write([user], {
+                'main_company': self.company.id,
+                'company': self.company.id,
+                })
+        with Transaction().set_context(company=self.company.id):
+            self._setup_accounts()
+            self._setup_fiscalyear()
+            self._setup_journal()
+            self._setup_taxes()
+            self._setup_parties()
+
+    def _setup_accounts(self):
+        pool = Pool()
+        AccountType = pool.get('account.account.type')
+        Account = pool.get('account.account')
+
+        type_, = AccountType.create([{
+                    'name': self.name,
+                    'company': self.company.id,
+                    }])
+        root, = Account.create([{
+                    'name': self.name,
+                    'kind': 'view',
+                    'company': self.company.id,
+                    }])
+        values = {
+            'type': type_.id,
+            'parent': root.id,
+            'company': self.company.id,
+            }
+        self.payable, self.receivable, self.expense, self.tax_account = (
+            Account.create([
+                    dict(values, name='Payable', code='2',
+                        kind='payable', reconcile=True),
+                    dict(values, name='Receivable', code='1',
+                        kind='receivable', reconcile=True),
+                    dict(values, name='Expense', code='5', kind='expense'),
+                    dict(values, name='Tax', code='6', kind='other'),
+                    ]))
+
+    def _setup_fiscalyear(self):
+        pool = Pool()
+        Sequence = pool.get('ir.sequence')
+        SequenceStrict = pool.get('ir.sequence.strict')
+        FiscalYear = pool.get('account.fiscalyear')
+        Date = pool.get('ir.date')
+
+        year = Date.today().year
+        self.start_date = datetime.date(year, 1, 1)
+        self.end_date = datetime.date(year, 12, 31)
+        move_sequence, = Sequence.create([{
+                    'name': self.name,
+                    'code': 'account.move',
+                    'company': self.company.id,
+                    }])
+        sequences = SequenceStrict.create([{
+                    'name': '%s %s' % (self.name, name),
+                    'code': 'account.invoice',
+                    'company': self.company.id,
+                    } for name in _SEQUENCES])
+        values = dict((n, s.id) for n, s in zip(_SEQUENCES, sequences))
+        values.update({
+                'name': '%s %s' % (self.name, year),
+                'start_date': self.start_date,
+                'end_date': self.end_date,
+                'company': self.company.id,
+                'post_move_sequence': move_sequence.id,
+                })
+        fiscalyear, = FiscalYear.create([values])
+        FiscalYear.create_period([fiscalyear])
+
+    def _setup_journal(self):
+        pool = Pool()
+        Sequence = pool.get('ir.sequence')
+        Journal = pool.get('account.journal')
+
+        journals = Journal.search([('type', '=', 'expense')], limit=1)
+        if journals:
+            self.journal, = journals
+            return
+        sequence, = Sequence.create([{
+                    'name': 'Expense',
+                    'code': 'account.journal',
+                    }])
+        self.journal, = Journal.create([{
+                    'name': 'Expense',
+                    'code': 'EXP',
+                    'type': 'expense',
+                    'sequence': sequence.id,
+                    }])
+
+    def _setup_taxes(self):
+        Tax = Pool().get('account.tax')
+        self.taxes = Tax.create([{
+                    'name': '%s Tax %s' % (self.name, i),
+                    'description': 'Tax %s' % i,
+                    'type': 'percentage',
+                    'rate': Decimal(i) / 100,
+                    'invoice_account': self.tax_account.id,
+                    'credit_note_account': self.tax_account.id,
+                    'company': self.company.id,
+                    } for i in range(1, self.tax_count + 1)])
+
+    def _setup_parties(self):
+        Party = Pool().get('party.party')
+        self.parties = []
+        for sub in chunked(range(self.party_count), _CHUNK):
+            self.parties.extend(Party.create([{
+                            'name': '%s Party %s' % (self.name, i),
+                            'account_payable': self.payable.id,
+                            'account_receivable': self.receivable.id,
+                            'addresses': [('create', [{}])],
+                            } for i in sub]))
+        self.addresses = dict((p.id, p.addresses[0].id) for p in self.parties)
+
+    def get_liquidation(self):
+        party = self.rng.choice(self.parties)
+        date = self.start_date + datetime.timedelta(
+            self.rng.randint(0, (self.end_date - self.start_date).days))
+        return {
+            'company': self.company.id,
+            'type': 'out_liquidation',
+            'party': party.id,
+            'liquidation_address': self.addresses[party.id],
+            'liquidation_date': date,
+            'currency': self.company.currency.id,
+            'journal': self.journal.id,
+            'account': self.expense.id,
+            }
+
+    def get_taxes(self, count):
+        taxes = []
+        for sequence in range(1, count + 1):
+            tax = self.rng.choice(self.taxes)
+            base = Decimal(self.rng.randint(100, 1000000)) / 100
+            taxes.append({
+                    'sequence': sequence,
+                    'tax': tax.id,
+                    'description': tax.description,
+                    'account': self.tax_account.id,
+                    'base': base,
+                    'amount': (base * tax.rate).quantize(Decimal('0.01')),
+                    })
+        return taxes
+
+
+def create_liquidations(fixture, count, tax_lines):
+    '''
+    Create count liquidations of the fixture by chunks and return their ids
+    '''
+    pool = Pool()
+    Liquidation = pool.get('account.liquidation')
+    LiquidationTax = pool.get('account.liquidation.tax')
+    ids = []
+    with Transaction().set_context(company=fixture.company.id):
+        for sub in chunked(range(count), _CHUNK):
+            liquidations = Liquidation.create([fixture.get_liquidation()
+                    for _ in sub])
+            LiquidationTax.create([dict(t, liquidation=l.id)
+                    for l in liquidations
+                    for t in fixture.get_taxes(tax_lines)])
+            ids.extend(l.id for l in liquidations)
+            Transaction().cursor.commit()
+    return ids
+
+
+def measure_get_amount(ids, rng, samples=50, batch=100):
+    Liquidation = Pool().get('account.liquidation')
+    names = ['untaxed_amount', 'tax_amount', 'total_amount']
+    seconds = []
+    for _ in range(samples):
+        liquidations = Liquidation.browse(rng.sample(ids, min(batch,
+                    len(ids))))
+        seconds.append(_timed(Liquidation.get_amount, liquidations,
+                names)[0])
+    return _latencies(seconds)
+
+
+def measure_post(fixture, count):
+    '''
+    Post up to count pending liquidations of the fixture
+    '''
+    Liquidation = Pool().get('account.liquidation')
+    with Transaction().set_context(company=fixture.company.id):
+        liquidations = Liquidation.search([
+                ('company', '=', fixture.company.id),
+                ] + PENDING_DOMAIN,
+            order=[('liquidation_date', 'ASC'), ('id', 'ASC')], limit=count)
+        seconds, _ = _timed(Liquidation._post, liquidations)
+        Transaction().cursor.commit()
+    return {
+        'posted': len(liquidations),
+        'seconds': seconds,
+        'per_second': len(liquidations) / seconds if seconds else 0.0,
+        }
+
+
+def measure_onchange(fixture, samples=200):
+    pool = Pool()
+    Liquidation = pool.get('account.liquidation')
+    LiquidationTax = pool.get('account.liquidation.tax')
+    LiquidationTax.clear_tax_cache()
+    tax_seconds = []
+    amount_seconds = []
+    with Transaction().set_context(company=fixture.company.id):
+        liquidation = Liquidation(**fixture.get_liquidation())
+        for _ in range(samples):
+            values = fixture.get_taxes(1)[0]
+            line = LiquidationTax(liquidation=liquidation,
+                tax=values['tax'], base=values['base'],
+                amount=values['amount'], manual=True)
+            tax_seconds.append(_timed(line.on_change_tax)[0])
+            amount_seconds.append(_timed(line.on_change_with_amount)[0])
+    return {
+        'on_change_tax': _latencies(tax_seconds),
+        'on_change_with_amount': _latencies(amount_seconds),
+        }
+
+
+def measure_tree_view(fixture, samples=20, limit=80):
+    '''
+    Measure the search and read of the first page of the default tree view
+    '''
+    Liquidation = Pool().get('account.liquidation')
+    names = Liquidation.fields_view_get(view_type='tree')['fields'].keys()
+    seconds = []
+    with Transaction().set_context(company=fixture.company.id):
+        for _ in range(samples):
+            start = time.time()
+            liquidations = Liquidation.search([
+                    ('company', '=', fixture.company.id),
+                    ('type', '=', 'out_liquidation'),
+                    ], limit=limit)
+            Liquidation.read([l.id for l in liquidations], names)
+            seconds.append(time.time() - start)
+    return _latencies(seconds)
+
+
+def measure_amount_search(fixture, rng, samples=20):
+    '''
+    Measure the search of the liquidations above an amount within a month
+    '''
+    Liquidation = Pool().get('account.liquidation')
+    seconds = []
+    found = []
+    with Transaction().set_context(company=fixture.company.id):
+        for _ in range(samples):
+            start_date = fixture.start_date + datetime.timedelta(
+                rng.randint(0, 334))
+            end_date = start_date + datetime.timedelta(30)
+            amount = Decimal(rng.randint(100, 5000))
+            duration, liquidations = _timed(Liquidation.search, [
+                    ('company', '=', fixture.company.id),
+                    ('liquidation_date', '>=', start_date),
+                    ('liquidation_date', '<=', end_date),
+                    ('total_amount', '>', amount),
+                    ])
+            seconds.append(duration)
+            found.append(len(liquidations))
+    result = _latencies(seconds)
+    result['found_mean'] = sum(found) / float(len(found))
+    return result
+
+
+def explain(query):
+    '''
+    Return the lines of the query plan of the python-sql query
+    '''
+    cursor = Transaction().cursor
+    sql, params = tuple(query)
+    if backend.name() == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    cursor.execute(prefix + sql, params)
+    return [' '.join(unicode(c) for c in row) for row in cursor.fetchall()]
+
+
+def get_plans(fixture, ids, rng, sample=100):
+    '''
+    Return the query plans of the default list, of the join with the move
+    lines of get_amount and of the tax line reads
+    '''
+    pool = Pool()
+    Liquidation = pool.get('account.liquidation')
+    LiquidationTax = pool.get('account.liquidation.tax')
+    MoveLine = pool.get('account.move.line')
+    liquidation = Liquidation.__table__()
+    tax = LiquidationTax.__table__()
+    line = MoveLine.__table__()
+    sample = rng.sample(ids, min(sample, len(ids)))
+    start_date = fixture.start_date + datetime.timedelta(rng.randint(0, 334))
+
+    return {
+        'list': explain(liquidation.select(liquidation.id,
+                where=(liquidation.company == fixture.company.id)
+                & (liquidation.type == 'out_liquidation')
+                & (liquidation.state == 'posted'),
+                order_by=[liquidation.liquidation_date.desc,
+                    liquidation.id.desc],
+                limit=80)),
+        'amount_search': explain(liquidation.select(liquidation.id,
+                where=(liquidation.company == fixture.company.id)
+                & (liquidation.liquidation_date >= start_date)
+                & (liquidation.liquidation_date
+                    <= start_date + datetime.timedelta(30))
+                & (liquidation.total_amount > 1000))),
+        'move_join': explain(liquidation.join(line,
+                condition=(liquidation.move == line.move)
+                & (liquidation.account == line.account)
+                ).select(liquidation.id, Sum(line.credit - line.debit),
+                where=liquidation.id.in_(sample),
+                group_by=liquidation.id)),
+        'tax_lines': explain(tax.select(tax.id,
+                where=tax.liquidation.in_(sample),
+                order_by=[tax.liquidation, tax.sequence])),
+        }
+
+
+def run(sizes, companies=1, parties=100, taxes=3, tax_lines=2,
+        post_count=1000, seed=0):
+    '''
+    Run the benchmark in the current transaction and return the results
+    '''
+    rng = random.Random(seed)
+    fixtures = [Fixture('Benchmark %s' % i, rng, parties, taxes)
+        for i in range(companies)]
+    for fixture in fixtures:
+        fixture.setup()
+    Transaction().cursor.commit()
+
+    results = []
+    ids = []
+    for size in sorted(sizes):
+        missing = size - len(ids)
+        start = time.time()
+        for n, fixture in enumerate(fixtures):
+            count = missing // companies + (1 if n < missing % companies
+                else 0)
+            ids.extend(create_liquidations(fixture, count, tax_lines))
+        created = time.time() - start
+        fixture = fixtures[0]
+        results.append({
+                'size': size,
+                'create': {
+                    'created': missing,
+                    'seconds': created,
+                    'per_second': missing / created if created else 0.0,
+                    },
+                'get_amount': measure_get_amount(ids, rng),
+                'amount_search': measure_amount_search(fixture, rng),
+                'tree_view': measure_tree_view(fixture),
+                'onchange': measure_onchange(fixture),
+                'post': measure_post(fixture, post_count),
+                'plans': get_plans(fixture, ids, rng),
+                })
+        logger.info('Size %s done', size)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the purchase liquidations')
+    parser.add_argument('-c', '--config', dest='configfile', default=None)
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-u', '--user', dest='login', default='admin')
+    parser.add_argument('--sizes', dest='sizes', default='1000,10000',
+        help='comma separated numbers of liquidations')
+    parser.add_argument('--companies', dest='companies', type=int, default=1)
+    parser.add_argument('--parties', dest='parties', type=int, default=100)
+    parser.add_argument('--taxes', dest='taxes', type=int, default=3,
+        help='number of taxes per company')
+    parser.add_argument('--tax-lines', dest='tax_lines', type=int, default=2,
+        help='number of tax lines per liquidation')
+    parser.add_argument('--post', dest='post_count', type=int, default=1000,
+        help='number of liquidations posted at each size')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('--label', dest='label', default=None,
+        help='label of the run, like the commit')
+    parser.add_argument('-o', '--output', dest='output', default=None)
+    options = parser.parse_args()
+
+    config.update_etc(options.configfile)
+    logging.basicConfig(level=logging.INFO)
+    pool = init_pool(options.database)
+    User = pool.get('res.user')
+
+    with Transaction().start(options.database, 0, readonly=True):
+        user, = User.search([('login', '=', options.login)])
+        context = User.get_preferences(context_only=True)
+    with Transaction().start(options.database, user.id,
+            context=context) as transaction:
+        try:
+            results = run([int(s) for s in options.sizes.split(',')],
+                companies=options.companies, parties=options.parties,
+                taxes=options.taxes, tax_lines=options.tax_lines,
+                post_count=options.post_count, seed=options.seed)
+            transaction.cursor.commit()
+        except Exception:
+            transaction.cursor.rollback()
+            raise
+
+    report = {
+        'label': options.label,
+        'backend': backend.name(),
+        'date': datetime.datetime.now().isoformat(),
+        'options': {
+            'companies': options.companies,
+            'parties': options.parties,
+            'taxes': options.taxes,
+            'tax_lines': options.tax_lines,
+            'post': options.post_count,
+            'seed': options.seed,
+            },
+        'results': results,
+        }
+    output = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        json.dump(report, output, indent=2)
+        output.write('\n')
+    finally:
+        if options.output:
+            output.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+#This file is part of the nodux_account_purchase_settlement module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Company']
+__metaclass__ = PoolMeta
+
+
+class Company:
+    __name__ = 'company.company'
+
+    @classmethod
+    def write(cls, *args):
+        super(Company, cls).write(*args)
+        pool = Pool()
+        pool.get('account.liquidation.tax').clear_company_cache()
+        pool.get('account.liquidation').clear_defaults_cache()
@@ -3,25 +3,33 @@
 #The COPYRIGHT file at the top level of this repository contains
 #the full copyright notices and license terms.
 from decimal import Decimal
+from collections import defaultdict
 from trytond.model import ModelSingleton, ModelView, ModelSQL, fields, Workflow
 from trytond.transaction import Transaction
 from trytond.pyson import Eval, In, If, Bool, Id
 from trytond.pool import Pool
 from trytond.report import Report
+from trytond.rpc import RPC
+import logging
 import pytz
 from datetime import datetime,timedelta
 import time
-from sql import Literal
+from sql import Literal, Null
 from trytond.wizard import Wizard, StateView, StateTransition, StateAction, \
     Button
 from trytond import backend
+from trytond.config import config
+from trytond.cache import Cache
 from trytond.tools import reduce_ids, grouped_slice
 from sql.conditionals import Coalesce, Case
 from sql.aggregate import Count, Sum
 from sql.functions import Abs, Sign
 from trytond.modules.company import CompanyReport
+from .posting import PENDING_DOMAIN, lock_order, partition_liquidations, \
+    post_partition
+from . import profiling
 
-__all__ = ['AccountLiquidation', 'AccountLiquidationTax']
+__all__ = ['AccountLiquidation', 'AccountLiquidationTax', 'LiquidationReport']
 
 
 _STATES = {
@@ -39,6 +47,41 @@ _TYPE2JOURNAL = {
 
 _ZERO = Decimal('0.0')
 
+logger = logging.getLogger(__name__)
+
+class RateCache(object):
+    '''
+    Convert amounts between currencies reading the rate of each currency
+    and date only once
+    '''
+
+    def __init__(self):
+        self.rates = {}
+
+    def get_rate(self, currency, date):
+        Currency = Pool().get('currency.currency')
+        key = (currency.id, date)
+        if key not in self.rates:
+            with Transaction().set_context(date=date):
+                self.rates[key] = Currency(currency.id).rate
+        return self.rates[key]
+
+    def compute(self, from_currency, amount, to_currency, date):
+        '''
+        Return amount in from_currency converted to to_currency at date
+        '''
+        Currency = Pool().get('currency.currency')
+        if from_currency == to_currency:
+            return to_currency.round(amount)
+        from_rate = self.get_rate(from_currency, date)
+        to_rate = self.get_rate(to_currency, date)
+        if not from_rate or not to_rate:
+            # Let compute raise the missing rate error
+            with Transaction().set_context(date=date):
+                return Currency.compute(from_currency, amount, to_currency)
+        return to_currency.round(amount * to_rate / from_rate)
+
+
 class AccountLiquidation(ModelSQL, ModelView):
     'Account Liquidation'
     __name__ = 'account.liquidation'
@@ -65,12 +108,13 @@ class AccountLiquidation(ModelSQL, ModelView):
         ('draft', 'Draft'),
         ('validated', 'Confirm'),
         ('posted', 'Posted'),
+        ('cancel', 'Cancelled'),
         ], 'State', readonly=True)
 
     liquidation_date = fields.Date('Liquidation Date',
         states={
-            'readonly': Eval('state').in_(['posted', 'cancel']),
-            'required': Eval('state').in_(['posted']),
+            'readonly': Eval('state').in_(['validated', 'posted', 'cancel']),
+            'required': Eval('state').in_(['validated', 'posted']),
             },
         depends=['state'])
     accounting_date = fields.Date('Accounting Date', states=_STATES,
@@ -78,7 +122,7 @@ class AccountLiquidation(ModelSQL, ModelView):
     party = fields.Many2One('party.party', 'Party',
         required=True, states=_STATES, depends=_DEPENDS)
     party_lang = fields.Function(fields.Char('Party Language'),
-        'on_change_with_party_lang')
+        'get_party_currency')
     liquidation_address = fields.Many2One('party.address', 'Liquidation Address',
         required=True, states=_STATES, depends=['state', 'party'],
         domain=[('party', '=', Eval('party'))])
@@ -87,29 +131,52 @@ class AccountLiquidation(ModelSQL, ModelView):
             'readonly': ((Eval('state') != 'draft')),
             }, depends=['state'])
     currency_digits = fields.Function(fields.Integer('Currency Digits'),
-        'on_change_with_currency_digits')
+        'get_party_currency')
     currency_date = fields.Function(fields.Date('Currency Date'),
-        'on_change_with_currency_date')
+        'get_party_currency')
     journal = fields.Many2One('account.journal', 'Journal', required=True,
         states=_STATES, depends=_DEPENDS)
-    move = fields.Many2One('account.move', 'Move', readonly=True)
+    move = fields.Many2One('account.move', 'Move', readonly=True,
+        select=True)
+    cancel_move = fields.Many2One('account.move', 'Cancel Move',
+        readonly=True, states={
+            'invisible': ~Eval('cancel_move'),
+            }, depends=['cancel_move'])
     account = fields.Many2One('account.account', 'Account', required=True,
         states=_STATES, depends=_DEPENDS)
     taxes = fields.One2Many('account.liquidation.tax', 'liquidation', 'Tax Lines',
         states=_STATES, depends=_DEPENDS)
     comment = fields.Text('Comment', states=_STATES, depends=_DEPENDS)
 
-    untaxed_amount = fields.Function(fields.Numeric('Untaxed',
-            digits=(16, Eval('currency_digits', 2)),
-            depends=['currency_digits']),
-        'get_amount', searcher='search_untaxed_amount')
-    tax_amount = fields.Function(fields.Numeric('Tax', digits=(16,
-                Eval('currency_digits', 2)), depends=['currency_digits']),
-        'get_amount', searcher='search_tax_amount')
-    total_amount = fields.Function(fields.Numeric('Total liquidation', digits=(16,
-                Eval('currency_digits', 2)), depends=['currency_digits']),
-        'get_amount', searcher='search_total_amount')
-
+    untaxed_amount = fields.Numeric('Untaxed',
+        digits=(16, Eval('currency_digits', 2)), readonly=True, select=True,
+        depends=['currency_digits'])
+    tax_amount = fields.Numeric('Tax',
+        digits=(16, Eval('currency_digits', 2)), readonly=True, select=True,
+        depends=['currency_digits'])
+    total_amount = fields.Numeric('Total liquidation',
+        digits=(16, Eval('currency_digits', 2)), readonly=True, select=True,
+        depends=['currency_digits'])
+    open_amount = fields.Numeric('Open Amount',
+        digits=(16, Eval('currency_digits', 2)), readonly=True,
+        depends=['currency_digits'],
+        help='The amount of the payable lines not yet reconciled.\n'
+        'Partial payments are only deducted once they are reconciled.')
+    reconciled = fields.Boolean('Reconciled', readonly=True, select=True,
+        help='All the payable lines are reconciled.')
+
+    liquidation_report_cache = fields.Binary('Liquidation Report',
+        readonly=True)
+    liquidation_report_format = fields.Char('Liquidation Report Format',
+        readonly=True)
+    liquidation_report_cache_date = fields.Timestamp(
+        'Liquidation Report Date', readonly=True)
+    liquidation_report_language = fields.Char('Liquidation Report Language',
+        readonly=True)
+    ats_summary = fields.Many2One('account.liquidation.ats', 'ATS Summary',
+        readonly=True, select=True, ondelete='SET NULL')
+    _defaults_cache = Cache('account_liquidation.get_defaults',
+        context=False)
 
     @classmethod
     def __setup__(cls):
@@ -117,6 +184,12 @@ class AccountLiquidation(ModelSQL, ModelView):
 
         cls._error_messages.update({
             'delete_liquidation': 'You can not delete a liquidation that is posted!',
+            'delete_numbered': ('You can not delete liquidation '
+                '"%(liquidation)s" because it has been numbered.'),
+            'cancel_reconciled': ('You can not cancel liquidation '
+                '"%(liquidation)s" because its payable line is reconciled.'),
+            'posted_amount': ('The total of liquidation "%(liquidation)s" '
+                'changes from %(total)s to %(posted)s when posted.'),
             'no_liquidation_sequence': ('There is no liquidation sequence for '
                 'liquidation "%(liquidation)s" on the period/fiscal year '
                 '"%(period)s".'),
@@ -128,23 +201,155 @@ class AccountLiquidation(ModelSQL, ModelView):
                     },
 
                 'post': {
-                    'invisible': (Eval('state') == 'posted'),
+                    'invisible': Eval('state').in_(['posted', 'cancel']),
                     'readonly' : ~Eval('taxes', [0]),
                     #'readonly': Not(Bool(Eval('taxes'))
                     },
+                'cancel': {
+                    'invisible': Eval('state') == 'cancel',
+                    },
+                'draft': {
+                    'invisible': ((Eval('state') != 'cancel')
+                        | Bool(Eval('number'))),
+                    },
                 })
         cls._order.insert(0, ('liquidation_date', 'DESC'))
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+        sql_table = cls.__table__()
+
+        # Migration from 3.4: amounts are stored
+        amounts_exist = table.column_exist('total_amount')
+        open_amount_exist = table.column_exist('open_amount')
+
+        super(AccountLiquidation, cls).__register__(module_name)
+
+        if not amounts_exist:
+            names = ['untaxed_amount', 'tax_amount', 'total_amount']
+            cursor.execute(*sql_table.select(sql_table.id))
+            ids = [i for i, in cursor.fetchall()]
+            for sub_ids in grouped_slice(ids):
+                liquidations = cls.browse(sub_ids)
+                amounts = cls.get_amount(liquidations, names)
+                for liquidation in liquidations:
+                    cursor.execute(*sql_table.update(
+                            columns=[getattr(sql_table, n) for n in names],
+                            values=[amounts[n][liquidation.id]
+                                for n in names],
+                            where=sql_table.id == liquidation.id))
+
+        if not open_amount_exist:
+            cursor.execute(*sql_table.select(sql_table.id,
+                    where=sql_table.state.in_(['posted', 'cancel'])))
+            ids = [i for i, in cursor.fetchall()]
+            for sub_ids in grouped_slice(ids):
+                payments = cls.get_payment(cls.browse(sub_ids))
+                for liquidation_id, (amount, reconciled) in (
+                        payments.items()):
+                    cursor.execute(*sql_table.update(
+                            columns=[sql_table.open_amount,
+                                sql_table.reconciled],
+                            values=[amount, reconciled],
+                            where=sql_table.id == liquidation_id))
+
+        table = TableHandler(cursor, cls, module_name)
+        # Amount filters are mostly combined with a date range
+        table.index_action(['company', 'liquidation_date', 'total_amount'],
+            'add')
+        # Default domains and order of the liquidation lists
+        table.index_action(['company', 'type', 'state', 'liquidation_date'],
+            'add')
+        # Unpaid liquidations of a party
+        table.index_action(['party', 'reconciled'], 'add')
+
     @staticmethod
     def default_state():
         return 'draft'
 
+    @staticmethod
+    def default_untaxed_amount():
+        return _ZERO
+
+    @staticmethod
+    def default_tax_amount():
+        return _ZERO
+
+    @staticmethod
+    def default_total_amount():
+        return _ZERO
+
+    @staticmethod
+    def default_open_amount():
+        return _ZERO
+
+    @staticmethod
+    def default_reconciled():
+        return False
+
+    @classmethod
+    def get_party_currency(cls, liquidations, names):
+        '''
+        Return party_lang, currency_digits and currency_date of the
+        liquidations with one joined query per slice
+        '''
+        pool = Pool()
+        Party = pool.get('party.party')
+        Lang = pool.get('ir.lang')
+        Currency = pool.get('currency.currency')
+        Config = pool.get('ir.configuration')
+        Date = pool.get('ir.date')
+        cursor = Transaction().cursor
+
+        liquidation = cls.__table__()
+        party = Party.__table__()
+        lang = Lang.__table__()
+        currency = Currency.__table__()
+
+        result = dict((n, {}) for n in names)
+        default_lang = None
+        today = Date.today()
+        for sub_ids in grouped_slice([l.id for l in liquidations]):
+            cursor.execute(*liquidation.join(party, 'LEFT',
+                    condition=liquidation.party == party.id
+                    ).join(lang, 'LEFT',
+                    condition=party.lang == lang.id
+                    ).join(currency, 'LEFT',
+                    condition=liquidation.currency == currency.id
+                    ).select(liquidation.id, lang.code, currency.digits,
+                    liquidation.liquidation_date,
+                    where=reduce_ids(liquidation.id, sub_ids)))
+            for liquidation_id, code, digits, date in cursor.fetchall():
+                if 'party_lang' in result:
+                    if not code:
+                        if default_lang is None:
+                            default_lang = Config.get_language()
+                        code = default_lang
+                    result['party_lang'][liquidation_id] = code
+                if 'currency_digits' in result:
+                    result['currency_digits'][liquidation_id] = (
+                        digits if digits is not None else 2)
+                if 'currency_date' in result:
+                    # SQLite returns the date as string
+                    if isinstance(date, basestring):
+                        date = datetime.strptime(date, '%Y-%m-%d').date()
+                    result['currency_date'][liquidation_id] = date or today
+        return result
+
     @fields.depends('currency')
     def on_change_with_currency_digits(self, name=None):
         if self.currency:
             return self.currency.digits
         return 2
 
+    @fields.depends('liquidation_date')
+    def on_change_with_currency_date(self, name=None):
+        Date = Pool().get('ir.date')
+        return self.liquidation_date or Date.today()
+
     @fields.depends('party')
     def on_change_with_party_lang(self, name=None):
         Config = Pool().get('ir.configuration')
@@ -160,85 +365,90 @@ class AccountLiquidation(ModelSQL, ModelView):
         return context
 
     @classmethod
-    def get_amount(cls, invoices, names):
+    @profiling.profiled('get_amount')
+    def get_amount(cls, liquidations, names):
         pool = Pool()
-        InvoiceTax = pool.get('account.liquidation.tax')
-        Move = pool.get('account.move')
+        LiquidationTax = pool.get('account.liquidation.tax')
         MoveLine = pool.get('account.move.line')
+        Currency = pool.get('currency.currency')
         cursor = Transaction().cursor
 
-        untaxed_amount = dict((i.id, _ZERO) for i in invoices)
-        tax_amount = dict((i.id, _ZERO) for i in invoices)
-        total_amount = dict((i.id, _ZERO) for i in invoices)
-
-        type_name = cls.tax_amount._field.sql_type().base
-        tax = InvoiceTax.__table__()
-        to_round = False
-        for sub_ids in grouped_slice(invoices):
-            red_sql = reduce_ids(tax.liquidation, sub_ids)
-            cursor.execute(*tax.select(tax.liquidation,
-                    Coalesce(Sum(tax.amount), 0).as_(type_name),
+        ids = [l.id for l in liquidations]
+        untaxed_amount = dict((i, _ZERO) for i in ids)
+        tax_amount = dict((i, _ZERO) for i in ids)
+        total_amount = dict((i, _ZERO) for i in ids)
+
+        type_name = cls.total_amount.sql_type().base
+        liquidation = cls.__table__()
+        tax = LiquidationTax.__table__()
+        line = MoveLine.__table__()
+
+        currencies = {}
+        with_move = []
+        to_round = set()
+        for sub_ids in grouped_slice(ids):
+            red_sql = reduce_ids(liquidation.id, sub_ids)
+            cursor.execute(*liquidation.join(tax, 'LEFT',
+                    condition=tax.liquidation == liquidation.id
+                    ).select(liquidation.id, liquidation.currency,
+                    liquidation.move,
+                    Coalesce(Sum(tax.amount), 0).cast(type_name),
                     where=red_sql,
-                    group_by=tax.liquidation))
-            for invoice_id, sum_ in cursor.fetchall():
+                    group_by=[liquidation.id, liquidation.currency,
+                        liquidation.move]))
+            for liquidation_id, currency_id, move_id, sum_ in (
+                    cursor.fetchall()):
+                currencies[liquidation_id] = currency_id
+                if move_id:
+                    with_move.append(liquidation_id)
                 # SQLite uses float for SUM
                 if not isinstance(sum_, Decimal):
                     sum_ = Decimal(str(sum_))
-                    to_round = True
-                tax_amount[invoice_id] = sum_
-        # Float amount must be rounded to get the right precision
-        if to_round:
-            for invoice in invoices:
-                tax_amount[invoice.id] = invoice.currency.round(
-                    tax_amount[invoice.id])
-
-        invoices_move = set()
-        invoices_no_move = set()
-        for invoice in invoices:
-            if invoice.move:
-                invoices_move.add(invoice.id)
-            else:
-                invoices_no_move.add(invoice.id)
-        invoices_move = cls.browse(invoices_move)
-        invoices_no_move = cls.browse(invoices_no_move)
-
-        type_name = cls.total_amount._field.sql_type().base
-        invoice = cls.__table__()
-        move = Move.__table__()
-        line = MoveLine.__table__()
-        to_round = False
-        for sub_ids in grouped_slice(invoices_move):
-            red_sql = reduce_ids(invoice.id, sub_ids)
-            cursor.execute(*invoice.join(move,
-                    condition=invoice.move == move.id
-                    ).join(line, condition=move.id == line.move
-                    ).select(invoice.id,
+                    to_round.add(liquidation_id)
+                tax_amount[liquidation_id] = sum_
+
+        for sub_ids in grouped_slice(with_move):
+            red_sql = reduce_ids(liquidation.id, sub_ids)
+            cursor.execute(*liquidation.join(line,
+                    condition=(liquidation.move == line.move)
+                    & (liquidation.account == line.account)
+                    ).select(liquidation.id,
                     Coalesce(Sum(
-                            Case((line.second_currency == invoice.currency,
+                            Case((line.second_currency == liquidation.currency,
                                     Abs(line.amount_second_currency)
-                                    * Sign(line.debit - line.credit)),
-                                else_=line.debit - line.credit)),
+                                    * Sign(line.credit - line.debit)),
+                                else_=line.credit - line.debit)),
                         0).cast(type_name),
-                    where=(invoice.account == line.account) & red_sql,
-                    group_by=invoice.id))
-            for invoice_id, sum_ in cursor.fetchall():
+                    where=red_sql,
+                    group_by=liquidation.id))
+            for liquidation_id, sum_ in cursor.fetchall():
                 # SQLite uses float for SUM
                 if not isinstance(sum_, Decimal):
                     sum_ = Decimal(str(sum_))
-                    to_round = True
-                total_amount[invoice_id] = sum_
-
-        for invoice in invoices_move:
-            # Float amount must be rounded to get the right precision
-            if to_round:
-                total_amount[invoice.id] = invoice.currency.round(
-                    total_amount[invoice.id])
-            untaxed_amount[invoice.id] = (
-                total_amount[invoice.id] - tax_amount[invoice.id])
+                    to_round.add(liquidation_id)
+                total_amount[liquidation_id] = sum_
 
-        for invoice in invoices_no_move:
-            total_amount[invoice.id] = (
-                untaxed_amount[invoice.id] + tax_amount[invoice.id])
+        # Float amount must be rounded to get the right precision
+        if to_round:
+            currency_ids = set(currencies[i] for i in to_round)
+            rounders = dict((c.id, c.round)
+                for c in Currency.browse(list(currency_ids)))
+            for liquidation_id in to_round:
+                round_ = rounders[currencies[liquidation_id]]
+                tax_amount[liquidation_id] = round_(
+                    tax_amount[liquidation_id])
+                total_amount[liquidation_id] = round_(
+                    total_amount[liquidation_id])
+
+        with_move = set(with_move)
+        for liquidation_id in ids:
+            if liquidation_id in with_move:
+                untaxed_amount[liquidation_id] = (
+                    total_amount[liquidation_id] - tax_amount[liquidation_id])
+            else:
+                total_amount[liquidation_id] = (
+                    untaxed_amount[liquidation_id]
+                    + tax_amount[liquidation_id])
 
         result = {
             'untaxed_amount': untaxed_amount,
@@ -251,25 +461,138 @@ class AccountLiquidation(ModelSQL, ModelView):
                 del result[key]
         return result
 
-    @staticmethod
-    def default_currency():
-        Company = Pool().get('company.company')
+    @classmethod
+    def update_amounts(cls, liquidations):
+        '''
+        Store the amounts computed by get_amount on the liquidations and
+        return them
+        '''
+        names = ['untaxed_amount', 'tax_amount', 'total_amount']
+        amounts = cls.get_amount(liquidations, names)
+        to_write = []
+        for liquidation in liquidations:
+            values = dict((n, amounts[n][liquidation.id]) for n in names)
+            if any(getattr(liquidation, n) != v for n, v in values.items()):
+                to_write.extend(([liquidation], values))
+        if to_write:
+            cls.write(*to_write)
+        return amounts
+
+    @classmethod
+    def get_payment(cls, liquidations):
+        '''
+        Return for each liquidation id the open amount and the reconciled
+        flag from the unreconciled lines on the account of its move
+
+        The amount stays open until the payable line is reconciled, partial
+        payments are not linked to the liquidation. Cancelled liquidations
+        have nothing open and draft ones are not reconciled.
+        '''
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        Currency = pool.get('currency.currency')
+        cursor = Transaction().cursor
+        type_name = cls.open_amount.sql_type().base
+        liquidation = cls.__table__()
+        line = MoveLine.__table__()
+
+        result = {}
+        rounders = {}
+        for sub_ids in grouped_slice([l.id for l in liquidations]):
+            cursor.execute(*liquidation.join(line, 'LEFT',
+                    condition=(liquidation.move == line.move)
+                    & (liquidation.account == line.account)
+                    & (line.reconciliation == Null)
+                    ).select(liquidation.id, liquidation.state,
+                    liquidation.currency, Count(line.id),
+                    Coalesce(Sum(
+                            Case((line.second_currency == liquidation.currency,
+                                    Abs(line.amount_second_currency)
+                                    * Sign(line.credit - line.debit)),
+                                else_=line.credit - line.debit)),
+                        0).cast(type_name),
+                    where=reduce_ids(liquidation.id, sub_ids),
+                    group_by=[liquidation.id, liquidation.state,
+                        liquidation.currency]))
+            for liquidation_id, state, currency_id, count, amount in (
+                    cursor.fetchall()):
+                if state != 'posted':
+                    result[liquidation_id] = (_ZERO, state == 'cancel')
+                    continue
+                # SQLite uses float for SUM
+                if not isinstance(amount, Decimal):
+                    if currency_id not in rounders:
+                        rounders[currency_id] = Currency(currency_id).round
+                    amount = rounders[currency_id](Decimal(str(amount)))
+                result[liquidation_id] = (amount, not count)
+        return result
+
+    @classmethod
+    def update_payment(cls, liquidations):
+        '''
+        Store the open amount and the reconciled flag of the liquidations
+
+        The values are stored with SQL to keep the write date unchanged, a
+        reconciliation must not make the report cache stale.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        payments = cls.get_payment(liquidations)
+        to_update = defaultdict(list)
+        for liquidation in liquidations:
+            amount, reconciled = payments[liquidation.id]
+            if (liquidation.open_amount != amount
+                    or liquidation.reconciled != reconciled):
+                to_update[(amount, reconciled)].append(liquidation.id)
+        for (amount, reconciled), ids in to_update.items():
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.update(
+                        columns=[table.open_amount, table.reconciled],
+                        values=[amount, reconciled],
+                        where=reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def clear_defaults_cache(cls):
+        cls._defaults_cache.clear()
+
+    @classmethod
+    def _get_defaults(cls):
+        '''
+        Return the default journal and currency ids for the company of the
+        context, cached per company
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
+        Journal = pool.get('account.journal')
+        cursor = Transaction().cursor
         company_id = Transaction().context.get('company')
-        if company_id:
-            return Company(company_id).currency.id
+        defaults = cls._defaults_cache.get(company_id)
+        if defaults is None:
+            journal = Journal.__table__()
+            cursor.execute(*journal.select(journal.id,
+                    where=(journal.type == _TYPE2JOURNAL['out_liquidation'])
+                    & (journal.active == True),
+                    order_by=journal.id.asc, limit=1))
+            row = cursor.fetchone()
+            defaults = {
+                'journal': row[0] if row else None,
+                'currency': (Company(company_id).currency.id
+                    if company_id else None),
+                }
+            cls._defaults_cache.set(company_id, defaults)
+        return defaults
+
+    @classmethod
+    def default_currency(cls):
+        return cls._get_defaults()['currency']
 
     @staticmethod
     def default_company():
         return Transaction().context.get('company')
 
-    @staticmethod
-    def default_journal():
-        pool = Pool()
-        Journal = pool.get('account.journal')
-        journal = Journal.search([('type','=', 'expense')])
-
-        for j in journal:
-            return j.id
+    @classmethod
+    def default_journal(cls):
+        return cls._get_defaults()['journal']
 
     @staticmethod
     def default_date():
@@ -288,8 +611,8 @@ class AccountLiquidation(ModelSQL, ModelView):
         test_state = True
 
         accounting_date = self.accounting_date or self.liquidation_date
-        period_id = Period.find(self.company.id,
-            date=accounting_date, test_state=test_state)
+        period_id = Period.find_cached(self.company.id,
+            accounting_date, test_state=test_state)
         period = Period(period_id)
         sequence = period.get_invoice_sequence(self.type)
         if not sequence:
@@ -306,93 +629,428 @@ class AccountLiquidation(ModelSQL, ModelView):
                 vals['liquidation_date'] = Transaction().context['date']
         self.write([self], vals)
 
+    @classmethod
+    def copy(cls, liquidations, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.setdefault('state', 'draft')
+        default.setdefault('number', None)
+        default.setdefault('move', None)
+        default.setdefault('untaxed_amount', _ZERO)
+        default.setdefault('tax_amount', _ZERO)
+        default.setdefault('total_amount', _ZERO)
+        default.setdefault('cancel_move', None)
+        default.setdefault('ats_summary', None)
+        default.setdefault('open_amount', _ZERO)
+        default.setdefault('reconciled', False)
+        default.setdefault('liquidation_report_cache', None)
+        default.setdefault('liquidation_report_format', None)
+        default.setdefault('liquidation_report_cache_date', None)
+        default.setdefault('liquidation_report_language', None)
+        return super(AccountLiquidation, cls).copy(liquidations,
+            default=default)
+
+    def get_report_cache(self, language):
+        '''
+        Return the cached (format, data) of the report if it was rendered in
+        the language for the current version of the posted liquidation
+        '''
+        if (self.state == 'posted'
+                and self.liquidation_report_cache
+                and self.liquidation_report_cache_date == self.write_date
+                and self.liquidation_report_language == language):
+            return (self.liquidation_report_format,
+                self.liquidation_report_cache)
+
+    def set_report_cache(self, language, format_, data):
+        '''
+        Store the rendered report of the liquidation keyed by its write date
+        and language
+
+        The cache is stored with SQL to keep the write date unchanged, a later
+        write of the liquidation makes it stale.
+        '''
+        cursor = Transaction().cursor
+        table = self.__table__()
+        cursor.execute(*table.update(
+                columns=[table.liquidation_report_format,
+                    table.liquidation_report_cache,
+                    table.liquidation_report_cache_date,
+                    table.liquidation_report_language],
+                values=[format_,
+                    self.__class__.liquidation_report_cache.sql_format(data),
+                    self.write_date, language],
+                where=table.id == self.id))
+
     @classmethod
     def delete(cls, liquidations):
         if not liquidations:
             return True
+        Move = Pool().get('account.move')
         for liquidation in liquidations:
             if liquidation.state == 'posted':
                 cls.raise_user_error('delete_liquidation')
-        return super(AccountLiquidation, cls).delete(liquidations)
+            if liquidation.number:
+                cls.raise_user_error('delete_numbered', {
+                        'liquidation': liquidation.rec_name,
+                        })
+        # The draft moves of validated liquidations
+        moves = [l.move for l in liquidations if l.move]
+        # The tax lines of cancelled liquidations are deleted with them
+        with Transaction().set_context(_check_modify_taxes=False):
+            result = super(AccountLiquidation, cls).delete(liquidations)
+        if moves:
+            Move.delete(moves)
+        return result
 
-    def prepare_liquidation_lines(self):
-        pool = Pool()
-        Period = pool.get('account.period')
-        Move = pool.get('account.move')
-        Liquidation = pool.get('account.liquidation')
-        amount = Decimal(0.0)
-        move_lines = []
-        line_move_ids = []
-        move, = Move.create([{
-            'period': Period.find(self.company.id, date=self.liquidation_date),
+    @classmethod
+    @ModelView.button
+    def draft(cls, liquidations):
+        '''
+        Reset to draft the cancelled liquidations that were never numbered
+        '''
+        cls.write([l for l in liquidations
+                if l.state == 'cancel' and not l.number], {
+                'state': 'draft',
+                })
+
+    def _get_move(self):
+        '''
+        Return the values of the move for the liquidation
+        '''
+        Period = Pool().get('account.period')
+        return {
+            'period': Period.find_cached(self.company.id,
+                self.liquidation_date),
             'journal': self.journal.id,
             'date': self.liquidation_date,
             'origin': str(self),
-        }])
+            }
 
-        self.write([self], {
-                'move': move.id,
-                })
+    @profiling.profiled('prepare_liquidation_lines')
+    def prepare_liquidation_lines(self, rates=None):
+        '''
+        Return the values of the move lines for the liquidation
 
+        The amounts are converted to the company currency with the rates
+        of the RateCache which is shared by the liquidations of a batch.
+        '''
+        pool = Pool()
+        Period = pool.get('account.period')
+        if rates is None:
+            rates = RateCache()
+        move_lines = []
+        period_id = Period.find_cached(self.company.id, self.liquidation_date)
+        company_currency = self.company.currency
+        foreign = self.currency != company_currency
+        # The tax lines are on the debit side of a purchase liquidation
+        sign = 1 if self.type == 'out_liquidation' else -1
+
+        def amounts(amount):
+            values = {
+                'amount_second_currency': None,
+                'second_currency': None,
+                }
+            if foreign:
+                values['amount_second_currency'] = amount * sign
+                values['second_currency'] = self.currency.id
+                amount = rates.compute(self.currency, amount,
+                    company_currency, self.currency_date)
+            values['debit'] = amount * sign if amount * sign > 0 else _ZERO
+            values['credit'] = -amount * sign if amount * sign < 0 else _ZERO
+            return amount, values
+
+        total = _ZERO
+        total_second_currency = _ZERO
         for tax in self.taxes:
-            amount += tax.amount
-
-        if self.type == 'out_liquidation':
-            debit = Decimal('0.00')
-            credit = amount
-        else:
-            debit = self.total_amount
-            credit = Decimal('0.00')
-        move_lines.append({
-            'description': self.number,
-            'debit': debit,
-            'credit': credit,
-            'account': self.account.id,
-            'move': move.id,
-            'journal': self.journal.id,
-            'period': Period.find(self.company.id, date=self.liquidation_date),
-            })
-        if self.taxes:
-            for tax in self.taxes:
-                if self.type == 'out_liquidation':
-                    debit = tax.amount
-                    credit = Decimal('0.00')
-
-                move_lines.append({
+            amount, values = amounts(tax.amount)
+            total += amount
+            total_second_currency += tax.amount
+            values.update({
                     'description': tax.description,
-                    'debit': debit,
-                    'credit': credit,
                     'account': tax.account.id,
-                    'move': move.id,
                     'journal': self.journal.id,
-                    'party':self.party,
-                    'period': Period.find(self.company.id, date=self.liquidation_date),
+                    'period': period_id,
                     })
+            if tax.account.party_required:
+                values['party'] = self.party.id
+            move_lines.append(values)
+
+        # The payable line balances the converted tax lines
+        sign = -sign
+        values = {
+            'description': self.number,
+            'debit': total * sign if total * sign > 0 else _ZERO,
+            'credit': -total * sign if total * sign < 0 else _ZERO,
+            'amount_second_currency': (total_second_currency * sign
+                if foreign else None),
+            'second_currency': self.currency.id if foreign else None,
+            'account': self.account.id,
+            'party': self.party.id,
+            'journal': self.journal.id,
+            'period': period_id,
+            }
+        move_lines.insert(0, values)
         return move_lines
 
-    def posted(self, move_lines):
+    @classmethod
+    def _post_chunk_size(cls):
+        return config.getint('account_liquidation', 'post_chunk_size',
+            default=500)
+
+    @classmethod
+    def _draft_moves(cls, liquidations, rates):
+        '''
+        Create the draft moves of the liquidations with one create for the
+        moves and one for the lines and return the moves
+        '''
         pool = Pool()
         Move = pool.get('account.move')
         MoveLine = pool.get('account.move.line')
-        created_lines = MoveLine.create(move_lines)
-        Move.post([self.move])
-        return True
+
+        with profiling.stage('draft.move_create'):
+            moves = Move.create([l._get_move() for l in liquidations])
+        move_lines = []
+        for liquidation, move in zip(liquidations, moves):
+            for line in liquidation.prepare_liquidation_lines(rates):
+                line['move'] = move.id
+                move_lines.append(line)
+        with profiling.stage('draft.move_line_create'):
+            MoveLine.create(move_lines)
+        return moves
 
     @classmethod
     @ModelView.button
-    @Workflow.transition('validated')
-    def validate_invoice(cls, liquidations):
-        for liquidation in liquidations:
-            invoice.create_move()
+    def validate_liquidation(cls, liquidations):
+        '''
+        Draft the moves of the draft liquidations by chunks
+
+        The periods are found and the amounts converted at validation, so
+        posting only has to number and post the moves.
+        '''
+        Date = Pool().get('ir.date')
+        liquidations = [l for l in lock_order(liquidations)
+            if l.state == 'draft']
+        undated = [l for l in liquidations if not l.liquidation_date]
+        if undated:
+            cls.write(undated, {'liquidation_date': Date.today()})
+        rates = RateCache()
+        for sub_liquidations in grouped_slice(liquidations,
+                cls._post_chunk_size()):
+            sub_liquidations = list(sub_liquidations)
+            moves = cls._draft_moves(sub_liquidations, rates)
+            to_write = []
+            for liquidation, move in zip(sub_liquidations, moves):
+                to_write.extend(([liquidation], {
+                            'move': move.id,
+                            'state': 'validated',
+                            }))
+            cls.write(*to_write)
 
     @classmethod
     @ModelView.button
     def post(cls, liquidations):
-        for liquidation in liquidations:
-            liquidation.set_number()
-            move_lines = liquidation.prepare_liquidation_lines()
-            liquidation.posted(move_lines)
-        cls.write(liquidations, {'state': 'posted'})
+        Queue = Pool().get('account.liquidation.post.queue')
+        if Queue.is_enabled():
+            Queue.enqueue(liquidations)
+        else:
+            cls._post(liquidations)
+
+    @classmethod
+    @profiling.profiled('post')
+    def _post(cls, liquidations):
+        '''
+        Number the liquidations and post their moves by chunks
+
+        The moves of the validated liquidations are already drafted, only
+        the description of their payable line is set to the number.
+        '''
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+
+        rates = RateCache()
+        for sub_liquidations in grouped_slice(lock_order(liquidations),
+                cls._post_chunk_size()):
+            sub_liquidations = list(sub_liquidations)
+            totals = dict((l.id, l.total_amount) for l in sub_liquidations)
+            with profiling.stage('post.set_number'):
+                for liquidation in sub_liquidations:
+                    liquidation.set_number()
+
+            to_draft = [l for l in sub_liquidations if not l.move]
+            moves = dict((l.id, m) for l, m in zip(to_draft,
+                    cls._draft_moves(to_draft, rates)))
+            to_describe = []
+            for liquidation in sub_liquidations:
+                if liquidation.id in moves:
+                    continue
+                moves[liquidation.id] = liquidation.move
+                lines = [l for l in liquidation.move.lines
+                    if l.account == liquidation.account
+                    and l.description != liquidation.number]
+                if lines:
+                    to_describe.extend((lines, {
+                                'description': liquidation.number,
+                                }))
+            if to_describe:
+                with profiling.stage('post.move_line_write'):
+                    MoveLine.write(*to_describe)
+
+            to_write = []
+            for liquidation in sub_liquidations:
+                to_write.extend(([liquidation], {
+                            'move': moves[liquidation.id].id,
+                            'state': 'posted',
+                            }))
+            with profiling.stage('post.move_post'):
+                Move.post([moves[l.id] for l in sub_liquidations])
+            with profiling.stage('post.write'):
+                cls.write(*to_write)
+                amounts = cls.update_amounts(sub_liquidations)
+                cls.update_payment(sub_liquidations)
+            for liquidation in sub_liquidations:
+                posted = amounts['total_amount'][liquidation.id]
+                if posted != totals[liquidation.id]:
+                    cls.raise_user_error('posted_amount', {
+                            'liquidation': liquidation.rec_name,
+                            'total': totals[liquidation.id],
+                            'posted': posted,
+                            })
+
+    def _get_cancel_move(self):
+        '''
+        Return the values of the move reversing the move of the liquidation
+        '''
+        move = self.move
+        lines = []
+        for line in move.lines:
+            lines.append({
+                    'description': line.description,
+                    'debit': line.credit,
+                    'credit': line.debit,
+                    'account': line.account.id,
+                    'party': line.party.id if line.party else None,
+                    'amount_second_currency': (-line.amount_second_currency
+                        if line.amount_second_currency else None),
+                    'second_currency': (line.second_currency.id
+                        if line.second_currency else None),
+                    })
+        return {
+            'period': move.period.id,
+            'journal': move.journal.id,
+            'date': move.date,
+            'origin': str(self),
+            'description': self.number,
+            }, lines
+
+    @classmethod
+    def check_cancel(cls, liquidations):
+        '''
+        Check that no posted liquidation has a reconciled payable line
+        '''
+        MoveLine = Pool().get('account.move.line')
+        cursor = Transaction().cursor
+        liquidation = cls.__table__()
+        line = MoveLine.__table__()
+        for sub_ids in grouped_slice([l.id for l in liquidations]):
+            cursor.execute(*liquidation.join(line,
+                    condition=(liquidation.move == line.move)
+                    & (liquidation.account == line.account)
+                    ).select(liquidation.id,
+                    where=reduce_ids(liquidation.id, sub_ids)
+                    & (liquidation.state == 'posted')
+                    & (line.reconciliation != Null),
+                    limit=1))
+            row = cursor.fetchone()
+            if row:
+                liquidation_id, = row
+                cls.raise_user_error('cancel_reconciled', {
+                        'liquidation': cls(liquidation_id).rec_name,
+                        })
+
+    @classmethod
+    @ModelView.button
+    def cancel(cls, liquidations):
+        '''
+        Cancel the liquidations by chunks
+
+        The draft moves are deleted and the posted moves are reversed by a
+        cancel move with the payable lines reconciled.
+        '''
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Reconciliation = pool.get('account.move.reconciliation')
+
+        liquidations = [l for l in lock_order(liquidations)
+            if l.state != 'cancel']
+        cls.check_cancel(liquidations)
+        for sub_liquidations in grouped_slice(liquidations,
+                cls._post_chunk_size()):
+            sub_liquidations = list(sub_liquidations)
+            to_delete = [l.move for l in sub_liquidations
+                if l.move and l.move.state != 'posted']
+            to_reverse = [l for l in sub_liquidations
+                if l.move and l.move.state == 'posted']
+
+            values = [l._get_cancel_move() for l in to_reverse]
+            cancel_moves = Move.create([m for m, _ in values])
+            move_lines = []
+            for cancel_move, (_, lines) in zip(cancel_moves, values):
+                for line in lines:
+                    line['move'] = cancel_move.id
+                    move_lines.append(line)
+            MoveLine.create(move_lines)
+            Move.post(cancel_moves)
+
+            reconciliations = []
+            for liquidation, cancel_move in zip(to_reverse, cancel_moves):
+                lines = [l for m in (liquidation.move, cancel_move)
+                    for l in m.lines
+                    if l.account == liquidation.account
+                    and not l.reconciliation]
+                if liquidation.account.reconcile and lines:
+                    reconciliations.append({
+                            'lines': [('add', [l.id for l in lines])],
+                            })
+            if reconciliations:
+                Reconciliation.create(reconciliations)
+
+            to_write = [sub_liquidations, {'state': 'cancel'}]
+            for liquidation, cancel_move in zip(to_reverse, cancel_moves):
+                to_write.extend(([liquidation], {
+                            'cancel_move': cancel_move.id,
+                            }))
+            deleted = set(m.id for m in to_delete)
+            to_clear = [l for l in sub_liquidations
+                if l.move and l.move.id in deleted]
+            if to_clear:
+                to_write.extend((to_clear, {'move': None}))
+            cls.write(*to_write)
+            if to_delete:
+                Move.delete(to_delete)
+                cls.update_amounts(to_clear)
+            cls.update_payment(sub_liquidations)
+
+    @classmethod
+    def post_pending(cls):
+        '''
+        Post the pending liquidations partition by partition, each one in its
+        own transaction
+
+        Used by the cron, the parallel posting is done by the posting script.
+        '''
+        transaction = Transaction()
+        for key, ids in partition_liquidations(cls.search(PENDING_DOMAIN)):
+            with transaction.new_cursor():
+                try:
+                    post_partition(ids)
+                    Transaction().cursor.commit()
+                except Exception:
+                    Transaction().cursor.rollback()
+                    logger.exception('Posting of partition %s failed', key)
 
 class AccountLiquidationTax(ModelSQL, ModelView):
     'Account Liquidation Tax'
@@ -431,6 +1089,13 @@ class AccountLiquidationTax(ModelSQL, ModelView):
             },
         depends=['manual'])
     tipo = fields.Char('Tipo de retencion')
+    _company_currency_cache = Cache(
+        'account_liquidation_tax.get_company_currency', context=False)
+    _tax_values_cache = Cache('account_liquidation_tax.on_change_tax',
+        context=False)
+    _tax_amount_cache = Cache('account_liquidation_tax.compute_tax_amount',
+        context=False)
+
     @classmethod
     def __setup__(cls):
         super(AccountLiquidationTax, cls).__setup__()
@@ -452,6 +1117,9 @@ class AccountLiquidationTax(ModelSQL, ModelView):
                     '"%(liquidation)s" on company "%(liquidation_company)s" using tax '
                     'code "%(tax_code)s" from company '
                     '"%(tax_code_company)s".'),
+                'invalid_company_lines': ('Some liquidation tax lines do not '
+                    'belong to the company of their liquidation:\n'
+                    '%(lines)s'),
                 })
 
     @classmethod
@@ -465,6 +1133,9 @@ class AccountLiquidationTax(ModelSQL, ModelView):
         # Migration from 2.4: drop required on sequence
         table.not_null_action('sequence', action='remove')
 
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['liquidation', 'sequence'], 'add')
+
     @staticmethod
     def order_sequence(tables):
         table, _ = tables[None]
@@ -490,22 +1161,50 @@ class AccountLiquidationTax(ModelSQL, ModelView):
     def default_tax_sign():
         return Decimal('1')
 
+    @classmethod
+    def clear_tax_cache(cls):
+        cls._tax_values_cache.clear()
+        cls._tax_amount_cache.clear()
+
+    @classmethod
+    def clear_company_cache(cls):
+        cls._company_currency_cache.clear()
+
+    @classmethod
+    def get_company_currency(cls):
+        '''
+        Return the currency of the company of the context
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
+        Currency = pool.get('currency.currency')
+        company_id = Transaction().context['company']
+        currency_id = cls._company_currency_cache.get(company_id)
+        if currency_id is None:
+            currency_id = Company(company_id).currency.id
+            cls._company_currency_cache.set(company_id, currency_id)
+        return Currency(currency_id)
+
     @fields.depends('tax', '_parent_liquidation.party', '_parent_liquidation.type')
     def on_change_tax(self):
         Tax = Pool().get('account.tax')
-        changes = {}
-        if self.tax:
-            if self.liquidation:
-                context = self.liquidation.get_tax_context()
-            else:
-                context = {}
+        if not self.tax:
+            return {}
+        if self.liquidation:
+            context = self.liquidation.get_tax_context()
+        else:
+            context = {}
+        if self.liquidation and self.liquidation.type:
+            liquidation_type = self.liquidation.type
+        else:
+            liquidation_type = 'out_liquidation'
+        key = (self.tax.id, context.get('language'), liquidation_type)
+        changes = self._tax_values_cache.get(key)
+        if changes is None:
+            changes = {}
             with Transaction().set_context(**context):
                 tax = Tax(self.tax.id)
             changes['description'] = tax.description
-            if self.liquidation and self.liquidation.type:
-                liquidation_type = self.liquidation.type
-            else:
-                liquidation_type = 'out_liquidation'
             if liquidation_type in ('out_liquidation', 'in_liquidation'):
                 changes['base_code'] = (tax.invoice_base_code.id
                     if tax.invoice_base_code else None)
@@ -514,146 +1213,254 @@ class AccountLiquidationTax(ModelSQL, ModelView):
                     if tax.invoice_tax_code else None)
                 changes['tax_sign'] = tax.invoice_tax_sign
                 changes['account'] = tax.invoice_account.id
-        return changes
+            self._tax_values_cache.set(key, changes)
+        return changes.copy()
+
+    def _compute_tax_amount(self, base):
+        '''
+        Return the amount computed by the tax for the base or None
+        '''
+        pool = Pool()
+        Tax = pool.get('account.tax')
+        Date = pool.get('ir.date')
+        key = (self.tax.id, base, Transaction().language, Date.today())
+        cached = self._tax_amount_cache.get(key)
+        if cached is None:
+            amount = None
+            for values in Tax.compute([self.tax], base, 1):
+                if (values['tax'] == self.tax
+                        and values['base'] == base):
+                    amount = values['amount']
+                    break
+            cached = (amount,)
+            self._tax_amount_cache.set(key, cached)
+        return cached[0]
 
     @fields.depends('tax', 'base', 'amount', 'manual')
     def on_change_with_amount(self):
-        Tax = Pool().get('account.tax')
-        transaction = Transaction()
-        company = transaction.context['company']
-        Company = Pool().get('company.company')
-        companies = Company.search([('id', '=', company)])
-        for c in companies:
-            company = c
+        currency = self.get_company_currency()
         if self.tax and self.manual:
-
-            tax = self.tax
-            base = self.base or Decimal(0)
-            for values in Tax.compute([tax], base, 1):
-                if (values['tax'] == tax
-                        and values['base'] == base):
-                    amount = company.currency.round(values['amount'])
-                    return amount
-        return company.currency.round(self.amount)
+            amount = self._compute_tax_amount(self.base or Decimal(0))
+            if amount is not None:
+                return currency.round(amount)
+        return currency.round(self.amount)
 
     @classmethod
     def check_modify(cls, taxes):
         '''
         Check if the taxes can be modified
         '''
-        for tax in taxes:
-            if tax.liquidation.state in ('posted', 'paid'):
-                cls.raise_user_error('modify')
+        Liquidation = Pool().get('account.liquidation')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        liquidation = Liquidation.__table__()
+        for sub_ids in grouped_slice([t.id for t in taxes]):
+            cursor.execute(*table.join(liquidation,
+                    condition=table.liquidation == liquidation.id
+                    ).select(table.id, liquidation.id,
+                    where=reduce_ids(table.id, sub_ids)
+                    & liquidation.state.in_(cls._readonly_states()),
+                    limit=1))
+            row = cursor.fetchone()
+            if row:
+                tax_id, liquidation_id = row
+                cls.raise_user_error('modify', {
+                        'tax': cls(tax_id).rec_name,
+                        'liquidation': Liquidation(liquidation_id).rec_name,
+                        })
+
+    @classmethod
+    def check_create(cls, vlist):
+        '''
+        Check if lines can be added to the liquidations of vlist
+        '''
+        Liquidation = Pool().get('account.liquidation')
+        cursor = Transaction().cursor
+        liquidation = Liquidation.__table__()
+        liquidation_ids = list(set(v['liquidation'] for v in vlist
+                if v.get('liquidation')))
+        for sub_ids in grouped_slice(liquidation_ids):
+            cursor.execute(*liquidation.select(liquidation.id,
+                    where=reduce_ids(liquidation.id, sub_ids)
+                    & liquidation.state.in_(cls._readonly_states()),
+                    limit=1))
+            row = cursor.fetchone()
+            if row:
+                liquidation_id, = row
+                vals = [v for v in vlist
+                    if v.get('liquidation') == liquidation_id][0]
+                cls.raise_user_error('create', {
+                        'line': vals.get('description', ''),
+                        'liquidation': Liquidation(liquidation_id).rec_name,
+                        })
+
+    @staticmethod
+    def _readonly_states():
+        return ['validated', 'posted', 'paid', 'cancel']
+
+    @classmethod
+    def get_sequence_number(cls, taxes, name):
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        sequence_numbers = dict((t.id, 0) for t in taxes)
+        liquidation_ids = list(set(t.liquidation.id for t in taxes
+                if t.liquidation))
+        for sub_ids in grouped_slice(liquidation_ids):
+            cursor.execute(*table.select(table.id, table.liquidation,
+                    where=reduce_ids(table.liquidation, sub_ids),
+                    order_by=[table.liquidation, table.sequence == None,
+                        table.sequence, table.id]))
+            liquidation_id, i = None, 0
+            for tax_id, tax_liquidation in cursor.fetchall():
+                if tax_liquidation != liquidation_id:
+                    liquidation_id, i = tax_liquidation, 0
+                i += 1
+                if tax_id in sequence_numbers:
+                    sequence_numbers[tax_id] = i
+        return sequence_numbers
+
+    @staticmethod
+    def _get_liquidation_ids(taxes):
+        return set(t.liquidation.id for t in taxes if t.liquidation)
 
-    def get_sequence_number(self, name):
-        i = 1
-        for tax in self.liquidation.taxes:
-            if tax == self:
-                return i
-            i += 1
-        return 0
+    @classmethod
+    def _update_liquidation_amounts(cls, liquidation_ids):
+        Liquidation = Pool().get('account.liquidation')
+        if liquidation_ids:
+            Liquidation.update_amounts(Liquidation.search([
+                        ('id', 'in', list(liquidation_ids)),
+                        ]))
 
     @classmethod
     def delete(cls, taxes):
-        cls.check_modify(taxes)
+        if Transaction().context.get('_check_modify_taxes', True):
+            cls.check_modify(taxes)
+        liquidation_ids = cls._get_liquidation_ids(taxes)
         super(AccountLiquidationTax, cls).delete(taxes)
+        cls._update_liquidation_amounts(liquidation_ids)
 
     @classmethod
     def write(cls, *args):
         taxes = sum(args[0::2], [])
         cls.check_modify(taxes)
+        cls.check_create([v for v in args[1::2] if v.get('liquidation')])
+        liquidation_ids = cls._get_liquidation_ids(taxes)
         super(AccountLiquidationTax, cls).write(*args)
+        liquidation_ids |= cls._get_liquidation_ids(
+            cls.browse([t.id for t in taxes]))
+        cls._update_liquidation_amounts(liquidation_ids)
 
     @classmethod
     def create(cls, vlist):
-        Liquidation = Pool().get('account.liquidation')
-        liquidation_ids = []
-        for vals in vlist:
-            if vals.get('Liquidation'):
-                liquidation_ids.append(vals['liquidation'])
-        for liquidation in Liquidation.browse(liquidation_ids):
-            if liquidation.state in ('posted'):
-                cls.raise_user_error('create')
-        return super(AccountLiquidationTax, cls).create(vlist)
+        cls.check_create(vlist)
+        taxes = super(AccountLiquidationTax, cls).create(vlist)
+        cls._update_liquidation_amounts(cls._get_liquidation_ids(taxes))
+        return taxes
 
     @classmethod
     def validate(cls, taxes):
         super(AccountLiquidationTax, cls).validate(taxes)
-        for tax in taxes:
-            tax.check_company()
-
-    def check_company(self):
-        company = self.liquidation.company
-        if self.account.company != company:
-            self.raise_user_error('invalid_account_company', {
-                    'liquidation': self.liquidation.rec_name,
-                    'liquidation_company': self.liquidation.company.rec_name,
-                    'account': self.account.rec_name,
-                    'account_company': self.account.company.rec_name,
-                    })
-        if self.base_code:
-            if self.base_code.company != company:
-                self.raise_user_error('invalid_base_code_company', {
-                        'liquidation': self.liquidation.rec_name,
-                        'liquidation_company': self.liquidation.company.rec_name,
-                        'base_code': self.base_code.rec_name,
-                        'base_code_company': self.base_code.company.rec_name,
-                        })
-        if self.tax_code:
-            if self.tax_code.company != company:
-                self.raise_user_error('invalid_tax_code_company', {
-                        'liquidation': self.liquidation.rec_name,
-                        'liquidation_company': self.liquidation.company.rec_name,
-                        'tax_code': self.tax_code.rec_name,
-                        'tax_code_company': self.tax_code.company.rec_name,
-                        })
+        cls.check_company(taxes)
 
-    def get_move_line(self):
+    @classmethod
+    def check_company(cls, taxes):
         '''
-        Return a list of move lines values for liquidation tax
+        Check that the account and tax codes of the taxes belong to the
+        company of their liquidation and report all the invalid lines at once
         '''
-        Currency = Pool().get('currency.currency')
-        res = {}
-        if not self.amount:
-            return []
-        res['description'] = self.description
-        if self.liquidation.currency != self.liquidation.company.currency:
-            with Transaction().set_context(date=self.liquidation.currency_date):
-                amount = Currency.compute(self.liquidation.currency, self.amount,
-                    self.liquidation.company.currency)
-            res['amount_second_currency'] = self.amount
-            res['second_currency'] = self.liquidation.currency.id
-        else:
-            amount = self.amount
-            res['amount_second_currency'] = None
-            res['second_currency'] = None
-        if self.liquidation.type in ('in_liquidation', 'out_credit_note'):
-            if amount >= Decimal('0.0'):
-                res['debit'] = amount
-                res['credit'] = Decimal('0.0')
-            else:
-                res['debit'] = Decimal('0.0')
-                res['credit'] = - amount
-                if res['amount_second_currency']:
-                    res['amount_second_currency'] = \
-                        - res['amount_second_currency']
-        else:
-            if amount >= Decimal('0.0'):
-                res['debit'] = Decimal('0.0')
-                res['credit'] = amount
-                if res['amount_second_currency']:
-                    res['amount_second_currency'] = \
-                        - res['amount_second_currency']
-            else:
-                res['debit'] = - amount
-                res['credit'] = Decimal('0.0')
-        res['account'] = self.account.id
-        if self.account.party_required:
-            res['party'] = self.liquidation.party.id
-        if self.tax_code:
-            res['tax_lines'] = [('create', [{
-                            'code': self.tax_code.id,
-                            'amount': amount * self.tax_sign,
-                            'tax': self.tax and self.tax.id or None
-                            }])]
-        return [res]
+        pool = Pool()
+        Liquidation = pool.get('account.liquidation')
+        Account = pool.get('account.account')
+        TaxCode = pool.get('account.tax.code')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        liquidation = Liquidation.__table__()
+        account = Account.__table__()
+        base_code = TaxCode.__table__()
+        tax_code = TaxCode.__table__()
+
+        invalid_ids = []
+        for sub_ids in grouped_slice([t.id for t in taxes]):
+            cursor.execute(*table.join(liquidation,
+                    condition=table.liquidation == liquidation.id
+                    ).join(account, condition=table.account == account.id
+                    ).join(base_code, 'LEFT',
+                    condition=table.base_code == base_code.id
+                    ).join(tax_code, 'LEFT',
+                    condition=table.tax_code == tax_code.id
+                    ).select(table.id,
+                    where=reduce_ids(table.id, sub_ids)
+                    & ((account.company != liquidation.company)
+                        | (base_code.company != liquidation.company)
+                        | (tax_code.company != liquidation.company))))
+            invalid_ids.extend(i for i, in cursor.fetchall())
+        if not invalid_ids:
+            return
+
+        errors = []
+        for tax in cls.browse(invalid_ids):
+            company = tax.liquidation.company
+            if tax.account.company != company:
+                errors.append(cls.raise_user_error('invalid_account_company', {
+                            'liquidation': tax.liquidation.rec_name,
+                            'liquidation_company': company.rec_name,
+                            'account': tax.account.rec_name,
+                            'account_company': tax.account.company.rec_name,
+                            }, raise_exception=False))
+            if tax.base_code and tax.base_code.company != company:
+                errors.append(cls.raise_user_error(
+                        'invalid_base_code_company', {
+                            'liquidation': tax.liquidation.rec_name,
+                            'liquidation_company': company.rec_name,
+                            'base_code': tax.base_code.rec_name,
+                            'base_code_company': (
+                                tax.base_code.company.rec_name),
+                            }, raise_exception=False))
+            if tax.tax_code and tax.tax_code.company != company:
+                errors.append(cls.raise_user_error(
+                        'invalid_tax_code_company', {
+                            'liquidation': tax.liquidation.rec_name,
+                            'liquidation_company': company.rec_name,
+                            'tax_code': tax.tax_code.rec_name,
+                            'tax_code_company': tax.tax_code.company.rec_name,
+                            }, raise_exception=False))
+        cls.raise_user_error('invalid_company_lines', {
+                'lines': '\n'.join(errors),
+                })
+
+
+class LiquidationReport(CompanyReport):
+    __name__ = 'account.liquidation'
+
+    @classmethod
+    def __setup__(cls):
+        super(LiquidationReport, cls).__setup__()
+        cls.__rpc__['execute'] = RPC(False)
+
+    @classmethod
+    def execute(cls, ids, data):
+        Liquidation = Pool().get('account.liquidation')
+        result = super(LiquidationReport, cls).execute(ids, data)
+        if len(ids) == 1:
+            liquidation = Liquidation(ids[0])
+            if liquidation.number:
+                result = result[:3] + (result[3] + ' - ' + liquidation.number,)
+        return result
+
+    @classmethod
+    def parse(cls, report, records, data, localcontext):
+        Lang = Pool().get('ir.lang')
+        language = Transaction().language
+        if len(records) == 1:
+            cached = records[0].get_report_cache(language)
+            if cached:
+                return cached
+        langs = Lang.search([
+                ('code', '=', language),
+                ], limit=1)
+        localcontext['lang'] = langs[0] if langs else None
+        result = super(LiquidationReport, cls).parse(report, records, data,
+            localcontext)
+        if len(records) == 1 and records[0].state == 'posted':
+            records[0].set_report_cache(language, *result)
+        return result
@@ -0,0 +1,389 @@
+#This file is part of the nodux_account_purchase_settlement module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''
+Streaming import of purchase liquidations from CSV or JSON lines files.
+
+CSV files have one row per tax line with the columns: reference, party,
+liquidation_date, accounting_date, description, account, tax, tax_description,
+tax_account, base, amount, tipo. Consecutive rows with the same reference
+make one liquidation. JSON files have one liquidation object per line with
+the same keys and a "taxes" list.
+
+Usage:
+    python -m trytond.modules.nodux_account_purchase_settlement.liquidation_import \\
+        -c trytond.conf -d database [-u admin] [--format csv] file
+'''
+import argparse
+import csv
+import datetime
+import io
+import json
+import logging
+from decimal import Decimal
+from itertools import groupby, islice
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from .posting import init_pool
+
+__all__ = ['LiquidationImportCheckpoint', 'LiquidationImportStart',
+    'LiquidationImport']
+
+logger = logging.getLogger(__name__)
+
+_LIQUIDATION_KEYS = ('reference', 'party', 'liquidation_date',
+    'accounting_date', 'description', 'account')
+_TAX_KEYS = ('tax', 'tax_description', 'tax_account', 'base', 'amount', 'tipo')
+# Marks in the lookup tables the keys matching several records
+_DUPLICATE = object()
+
+
+def _raise(error, values):
+    Import = Pool().get('account.liquidation.import', type='wizard')
+    Import.raise_user_error(error, values)
+
+
+def _numbered(rows):
+    '''
+    Yield the CSV rows with their line number
+    '''
+    for row in rows:
+        row['_row'] = rows.line_num
+        if not row.get('reference'):
+            _raise('missing_reference', {'row': row['_row']})
+        yield row
+
+
+def read_csv(lines):
+    '''
+    Yield the liquidations of the CSV lines
+    '''
+    rows = _numbered(csv.DictReader(lines))
+    for _, group in groupby(rows, key=lambda r: r['reference']):
+        liquidation = None
+        for row in group:
+            if liquidation is None:
+                liquidation = dict((k, row.get(k)) for k in _LIQUIDATION_KEYS)
+                liquidation['_row'] = row['_row']
+                liquidation['taxes'] = []
+            tax = dict((k, row.get(k)) for k in _TAX_KEYS)
+            tax['_row'] = row['_row']
+            liquidation['taxes'].append(tax)
+        yield liquidation
+
+
+def read_json(lines):
+    '''
+    Yield the liquidations of the JSON lines
+    '''
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if line:
+            liquidation = json.loads(line, parse_float=Decimal)
+            liquidation['_row'] = number
+            for tax in liquidation.get('taxes', []):
+                tax['_row'] = number
+            yield liquidation
+
+
+READERS = {
+    'csv': read_csv,
+    'json': read_json,
+    }
+
+
+def chunked(iterable, size):
+    '''
+    Yield lists of size items from iterable
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _date(value):
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class LiquidationImporter(object):
+    '''
+    Create the liquidations by chunks resolving the parties, accounts and
+    taxes through lookup tables filled once per distinct key
+    '''
+
+    def __init__(self):
+        self.parties = {}
+        self.addresses = {}
+        self.accounts = {}
+        self.taxes = {}
+
+    def _resolve(self, Model, field, lookup, keys, domain=None):
+        missing = list(set(k for k in keys if k and k not in lookup))
+        if missing:
+            for record in Model.search([(field, 'in', missing)]
+                    + (domain or [])):
+                key = getattr(record, field)
+                lookup[key] = _DUPLICATE if key in lookup else record
+
+    def resolve(self, liquidations):
+        pool = Pool()
+        Party = pool.get('party.party')
+        Account = pool.get('account.account')
+        Tax = pool.get('account.tax')
+
+        company_domain = [
+            ('company', '=', Transaction().context.get('company')),
+            ]
+        taxes = [t for l in liquidations for t in l['taxes']]
+        self._resolve(Party, 'code', self.parties,
+            [l['party'] for l in liquidations])
+        self._resolve(Account, 'code', self.accounts,
+            [l.get('account') for l in liquidations]
+            + [t.get('tax_account') for t in taxes], domain=company_domain)
+        self._resolve(Tax, 'name', self.taxes,
+            [t.get('tax') for t in taxes], domain=company_domain)
+
+    def _get(self, lookup, code, kind, record):
+        '''
+        Return the record of code in lookup or raise the unknown or
+        duplicate error of kind
+        '''
+        if code not in lookup:
+            error = 'unknown_%s' % kind
+        elif lookup[code] is _DUPLICATE:
+            error = 'duplicate_%s' % kind
+        else:
+            return lookup[code]
+        _raise(error, {
+                'code': code,
+                'reference': record.get('reference', ''),
+                'row': record.get('_row'),
+                })
+
+    def get_address(self, party):
+        if party.id not in self.addresses:
+            address = party.address_get(type='invoice')
+            self.addresses[party.id] = address.id if address else None
+        return self.addresses[party.id]
+
+    def get_liquidation_values(self, liquidation):
+        party = self._get(self.parties, liquidation['party'], 'party',
+            liquidation)
+        if liquidation.get('account'):
+            account = self._get(self.accounts, liquidation['account'],
+                'account', liquidation)
+        else:
+            account = party.account_payable
+        return {
+            'type': 'out_liquidation',
+            'reference': liquidation.get('reference'),
+            'description': liquidation.get('description'),
+            'party': party.id,
+            'liquidation_address': self.get_address(party),
+            'liquidation_date': _date(liquidation.get('liquidation_date')),
+            'accounting_date': _date(liquidation.get('accounting_date')),
+            'account': account.id,
+            }
+
+    def get_tax_values(self, liquidation, tax_line, sequence, currency):
+        values = {
+            'sequence': sequence,
+            'description': tax_line.get('tax_description'),
+            'base': currency.round(Decimal(tax_line.get('base') or 0)),
+            'amount': currency.round(Decimal(tax_line.get('amount') or 0)),
+            'tipo': tax_line.get('tipo'),
+            }
+        if tax_line.get('tax'):
+            tax = self._get(self.taxes, tax_line['tax'], 'tax',
+                dict(tax_line, reference=liquidation.get('reference')))
+            values.update({
+                    'tax': tax.id,
+                    'description': values['description'] or tax.description,
+                    'account': tax.invoice_account.id,
+                    'base_code': (tax.invoice_base_code.id
+                        if tax.invoice_base_code else None),
+                    'base_sign': tax.invoice_base_sign,
+                    'tax_code': (tax.invoice_tax_code.id
+                        if tax.invoice_tax_code else None),
+                    'tax_sign': tax.invoice_tax_sign,
+                    })
+        if tax_line.get('tax_account'):
+            values['account'] = self._get(self.accounts,
+                tax_line['tax_account'], 'account',
+                dict(tax_line, reference=liquidation.get('reference'))).id
+        return values
+
+    def create(self, liquidations):
+        '''
+        Create the liquidations and their taxes with one create call each
+        '''
+        pool = Pool()
+        Liquidation = pool.get('account.liquidation')
+        LiquidationTax = pool.get('account.liquidation.tax')
+
+        self.resolve(liquidations)
+        records = Liquidation.create([self.get_liquidation_values(l)
+                for l in liquidations])
+        LiquidationTax.create([
+                dict(self.get_tax_values(liquidation, t, i, record.currency),
+                    liquidation=record.id)
+                for record, liquidation in zip(records, liquidations)
+                for i, t in enumerate(liquidation['taxes'], 1)])
+        return records
+
+
+class LiquidationImportCheckpoint(ModelSQL, ModelView):
+    'Purchase Liquidation Import Checkpoint'
+    __name__ = 'account.liquidation.import.checkpoint'
+    name = fields.Char('Name', required=True, readonly=True, select=True)
+    position = fields.Integer('Position', readonly=True,
+        help='Number of liquidations already imported from the file.')
+
+    @classmethod
+    def __setup__(cls):
+        super(LiquidationImportCheckpoint, cls).__setup__()
+        cls._sql_constraints += [
+            ('name_uniq', 'UNIQUE(name)',
+                'The name of the import checkpoint must be unique.'),
+            ]
+
+    @staticmethod
+    def default_position():
+        return 0
+
+    @classmethod
+    def get(cls, name):
+        checkpoints = cls.search([('name', '=', name)], limit=1)
+        if checkpoints:
+            return checkpoints[0]
+        checkpoint, = cls.create([{'name': name}])
+        return checkpoint
+
+
+def import_liquidations(liquidations, checkpoint=None, chunk_size=None,
+        commit=False):
+    '''
+    Import the liquidations by chunks of chunk_size
+
+    The first liquidations already imported according to the checkpoint are
+    skipped and the checkpoint is moved forward with each chunk. When commit
+    is set, the transaction is committed after each chunk so an interrupted
+    import can be resumed with the same checkpoint.
+    '''
+    Checkpoint = Pool().get('account.liquidation.import.checkpoint')
+    if chunk_size is None:
+        chunk_size = config.getint('account_liquidation',
+            'import_chunk_size', default=500)
+    importer = LiquidationImporter()
+    position = checkpoint.position if checkpoint else 0
+    count = 0
+    for chunk in chunked(islice(liquidations, position, None), chunk_size):
+        importer.create(chunk)
+        count += len(chunk)
+        if checkpoint:
+            Checkpoint.write([checkpoint], {
+                    'position': position + count,
+                    })
+        if commit:
+            Transaction().cursor.commit()
+    return count
+
+
+class LiquidationImportStart(ModelView):
+    'Purchase Liquidation Import Start'
+    __name__ = 'account.liquidation.import.start'
+    file_ = fields.Binary('File', required=True)
+    format_ = fields.Selection([
+            ('csv', 'CSV'),
+            ('json', 'JSON Lines'),
+            ], 'Format', required=True)
+
+    @staticmethod
+    def default_format_():
+        return 'csv'
+
+
+class LiquidationImport(Wizard):
+    'Purchase Liquidation Import'
+    __name__ = 'account.liquidation.import'
+    start = StateView('account.liquidation.import.start',
+        'nodux_account_purchase_settlement.liquidation_import_start_view_form',
+        [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+
+    @classmethod
+    def __setup__(cls):
+        super(LiquidationImport, cls).__setup__()
+        cls._error_messages.update({
+                'missing_reference': 'The row %(row)s has no reference.',
+                'unknown_party': ('Unknown party "%(code)s" for liquidation '
+                    '"%(reference)s" at row %(row)s.'),
+                'unknown_account': ('Unknown account "%(code)s" for '
+                    'liquidation "%(reference)s" at row %(row)s.'),
+                'unknown_tax': ('Unknown tax "%(code)s" for liquidation '
+                    '"%(reference)s" at row %(row)s.'),
+                'duplicate_party': ('Several parties match "%(code)s" for '
+                    'liquidation "%(reference)s" at row %(row)s.'),
+                'duplicate_account': ('Several accounts match "%(code)s" for '
+                    'liquidation "%(reference)s" at row %(row)s.'),
+                'duplicate_tax': ('Several taxes match "%(code)s" for '
+                    'liquidation "%(reference)s" at row %(row)s.'),
+                })
+
+    def transition_import_(self):
+        lines = io.BytesIO(self.start.file_)
+        import_liquidations(READERS[self.start.format_](lines))
+        return 'end'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Import purchase liquidations')
+    parser.add_argument('-c', '--config', dest='configfile', default=None)
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-u', '--user', dest='login', default='admin')
+    parser.add_argument('--format', dest='format_', default='csv',
+        choices=sorted(READERS))
+    parser.add_argument('--chunk', dest='chunk_size', type=int, default=None)
+    parser.add_argument('--checkpoint', dest='checkpoint', default=None,
+        help='name of the checkpoint, defaults to the file name')
+    parser.add_argument('file', metavar='FILE')
+    options = parser.parse_args()
+
+    config.update_etc(options.configfile)
+    logging.basicConfig(level=logging.INFO)
+    pool = init_pool(options.database)
+    User = pool.get('res.user')
+    Checkpoint = pool.get('account.liquidation.import.checkpoint')
+
+    with Transaction().start(options.database, 0, readonly=True):
+        user, = User.search([('login', '=', options.login)])
+        context = User.get_preferences(context_only=True)
+    with Transaction().start(options.database, user.id,
+            context=context) as transaction:
+        try:
+            checkpoint = Checkpoint.get(options.checkpoint or options.file)
+            transaction.cursor.commit()
+            with open(options.file, 'rb') as lines:
+                count = import_liquidations(
+                    READERS[options.format_](lines), checkpoint=checkpoint,
+                    chunk_size=options.chunk_size, commit=True)
+        except Exception:
+            transaction.cursor.rollback()
+            raise
+    logger.info('Imported %s liquidations from %s', count, options.file)
+
+if __name__ == '__main__':
+    main()
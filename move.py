@@ -5,7 +5,7 @@ from decimal import Decimal
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 
-__all__ = ['Move']
+__all__ = ['Move', 'Reconciliation']
 __metaclass__ = PoolMeta
 
 
@@ -15,3 +15,33 @@ class Move:
     @classmethod
     def _get_origin(cls):
         return super(Move, cls)._get_origin() + ['account.liquidation']
+
+
+class Reconciliation:
+    __name__ = 'account.move.reconciliation'
+
+    @classmethod
+    def _get_liquidations(cls, reconciliations):
+        '''
+        Return the liquidations of the moves of the reconciled lines
+        '''
+        Liquidation = Pool().get('account.liquidation')
+        move_ids = list(set(l.move.id
+                for r in reconciliations for l in r.lines))
+        if not move_ids:
+            return []
+        return Liquidation.search([('move', 'in', move_ids)])
+
+    @classmethod
+    def create(cls, vlist):
+        Liquidation = Pool().get('account.liquidation')
+        reconciliations = super(Reconciliation, cls).create(vlist)
+        Liquidation.update_payment(cls._get_liquidations(reconciliations))
+        return reconciliations
+
+    @classmethod
+    def delete(cls, reconciliations):
+        Liquidation = Pool().get('account.liquidation')
+        liquidations = cls._get_liquidations(reconciliations)
+        super(Reconciliation, cls).delete(reconciliations)
+        Liquidation.update_payment(liquidations)
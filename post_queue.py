@@ -0,0 +1,156 @@
+#This file is part of the nodux_account_purchase_settlement module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+import datetime
+import logging
+
+from sql.aggregate import Count
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.config import config
+from trytond.transaction import Transaction
+from .posting import post_partition
+
+__all__ = ['LiquidationPostQueue']
+
+logger = logging.getLogger(__name__)
+
+
+class LiquidationPostQueue(ModelSQL, ModelView):
+    'Purchase Liquidation Post Queue'
+    __name__ = 'account.liquidation.post.queue'
+    liquidation = fields.Many2One('account.liquidation', 'Liquidation',
+        required=True, readonly=True, select=True, ondelete='CASCADE')
+    state = fields.Selection([
+            ('pending', 'Pending'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+            ], 'State', required=True, readonly=True, select=True)
+    error = fields.Text('Error', readonly=True)
+    processed_date = fields.Timestamp('Processed Date', readonly=True)
+    latency = fields.Function(fields.Float('Latency (s)', digits=(16, 3)),
+        'get_latency')
+
+    @classmethod
+    def __setup__(cls):
+        super(LiquidationPostQueue, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    def get_latency(self, name):
+        if self.processed_date and self.create_date:
+            return (self.processed_date
+                - self.create_date).total_seconds()
+
+    @staticmethod
+    def is_enabled():
+        '''
+        Return True if posting must be queued
+        '''
+        context = Transaction().context
+        if 'liquidation_post_async' in context:
+            return bool(context['liquidation_post_async'])
+        return config.getboolean('account_liquidation', 'async_post',
+            default=False)
+
+    @classmethod
+    def enqueue(cls, liquidations):
+        '''
+        Queue the liquidations that are not already pending
+        '''
+        pending = cls.search([
+                ('liquidation', 'in', [l.id for l in liquidations]),
+                ('state', '=', 'pending'),
+                ])
+        queued = set(q.liquidation.id for q in pending)
+        return cls.create([{'liquidation': l.id}
+                for l in liquidations if l.id not in queued])
+
+    @classmethod
+    def _process(cls, ids):
+        '''
+        Post the liquidations of the queue ids in a new transaction and
+        return True if it succeeded
+        '''
+        transaction = Transaction()
+        with transaction.new_cursor():
+            try:
+                items = cls.browse(ids)
+                post_partition([i.liquidation.id for i in items])
+                cls.write(items, {
+                        'state': 'done',
+                        'error': None,
+                        'processed_date': datetime.datetime.now(),
+                        })
+                Transaction().cursor.commit()
+                return True
+            except Exception as exception:
+                Transaction().cursor.rollback()
+                if len(ids) > 1:
+                    return False
+                logger.exception('Queued posting of %s failed', ids)
+                error = unicode(exception)
+        with transaction.new_cursor():
+            cls.write(cls.browse(ids), {
+                    'state': 'failed',
+                    'error': error,
+                    'processed_date': datetime.datetime.now(),
+                    })
+            Transaction().cursor.commit()
+        return False
+
+    @classmethod
+    def process(cls):
+        '''
+        Drain the queue by batches, a failing batch is retried item by item
+        '''
+        batch_size = config.getint('account_liquidation', 'queue_batch_size',
+            default=100)
+        transaction = Transaction()
+        while True:
+            with transaction.new_cursor():
+                ids = [q.id for q in cls.search([
+                            ('state', '=', 'pending'),
+                            ], order=[('id', 'ASC')], limit=batch_size)]
+            if not ids:
+                break
+            if not cls._process(ids):
+                for id_ in ids:
+                    cls._process([id_])
+        with transaction.new_cursor():
+            logger.info('Liquidation post queue: %s', cls.get_metrics())
+
+    @classmethod
+    def get_metrics(cls):
+        '''
+        Return the depth, the age of the oldest pending item, the number of
+        failed items and the latency of the last processed items
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        now = datetime.datetime.now()
+
+        cursor.execute(*table.select(table.state, Count(table.id),
+                group_by=table.state))
+        counts = dict(cursor.fetchall())
+        oldest = None
+        pending = cls.search([
+                ('state', '=', 'pending'),
+                ], order=[('id', 'ASC')], limit=1)
+        if pending:
+            oldest = (now - pending[0].create_date).total_seconds()
+
+        latencies = [q.latency for q in cls.search([
+                    ('state', '=', 'done'),
+                    ], order=[('processed_date', 'DESC')], limit=100)]
+        return {
+            'depth': counts.get('pending', 0),
+            'failed': counts.get('failed', 0),
+            'oldest_pending': oldest,
+            'latency_avg': (sum(latencies) / len(latencies)
+                if latencies else None),
+            'latency_max': max(latencies) if latencies else None,
+            }
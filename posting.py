@@ -0,0 +1,199 @@
+#This file is part of the nodux_account_purchase_settlement module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''
+Post pending purchase liquidations in parallel.
+
+The pending liquidations are partitioned by company and numbering sequence.
+Each partition is posted by a worker process in its own transaction and in
+date order, so the numbers stay gap-free and ordered inside each sequence
+and a failing partition is rolled back without affecting the others.
+
+Usage:
+    python -m trytond.modules.nodux_account_purchase_settlement.posting \\
+        -c trytond.conf -d database [-u admin] [-p 4]
+'''
+import argparse
+import json
+import logging
+import multiprocessing
+import time
+from collections import defaultdict
+
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['PENDING_DOMAIN', 'lock_order', 'partition_liquidations',
+    'post_partition', 'post_pending', 'throughput_report', 'init_pool']
+
+logger = logging.getLogger(__name__)
+
+PENDING_DOMAIN = [
+    ('state', 'in', ['draft', 'validated']),
+    ]
+
+
+def _lock_key(liquidation, today):
+    return (liquidation.accounting_date or liquidation.liquidation_date
+        or today, liquidation.id)
+
+
+def lock_order(liquidations):
+    '''
+    Return the liquidations sorted by accounting date and id, the order in
+    which posting and cancelling lock their sequences and moves
+    '''
+    Date = Pool().get('ir.date')
+    today = Date.today()
+    return sorted(liquidations, key=lambda l: _lock_key(l, today))
+
+
+def partition_liquidations(liquidations):
+    '''
+    Return a list of ((company id, sequence id), liquidation ids) with the
+    ids sorted by accounting date and id
+    '''
+    pool = Pool()
+    Period = pool.get('account.period')
+    Date = pool.get('ir.date')
+    today = Date.today()
+
+    partitions = defaultdict(list)
+    for liquidation in liquidations:
+        date, _ = lock_key = _lock_key(liquidation, today)
+        period_id = Period.find_cached(liquidation.company.id, date)
+        sequence = Period(period_id).get_invoice_sequence(liquidation.type)
+        key = (liquidation.company.id, sequence.id if sequence else None)
+        partitions[key].append(lock_key)
+    return [(key, [i for _, i in sorted(values)])
+        for key, values in sorted(partitions.items())]
+
+
+def post_partition(ids):
+    '''
+    Post the pending liquidations of ids in the order of ids
+    '''
+    Liquidation = Pool().get('account.liquidation')
+    order = dict((i, n) for n, i in enumerate(ids))
+    liquidations = Liquidation.search([
+            ('id', 'in', ids),
+            ] + PENDING_DOMAIN)
+    liquidations.sort(key=lambda l: order[l.id])
+    Liquidation._post(liquidations)
+    return len(liquidations)
+
+
+def throughput_report(results, elapsed):
+    '''
+    Return a summary of the partition results
+    '''
+    posted = sum(r['posted'] for r in results)
+    return {
+        'partitions': len(results),
+        'failed': [r for r in results if r['error']],
+        'posted': posted,
+        'seconds': elapsed,
+        'per_second': posted / elapsed if elapsed else 0.0,
+        'details': results,
+        }
+
+
+def init_pool(database_name):
+    '''
+    Return the pool of the database initializing it if needed
+    '''
+    if database_name not in Pool.database_list():
+        with Transaction().start(database_name, 0, readonly=True):
+            Pool(database_name).init()
+    return Pool(database_name)
+
+
+def _get_partitions(database_name, login):
+    pool = init_pool(database_name)
+    User = pool.get('res.user')
+    Liquidation = pool.get('account.liquidation')
+
+    Cache.clean(database_name)
+    with Transaction().start(database_name, 0, readonly=True):
+        user, = User.search([('login', '=', login)])
+        context = User.get_preferences(context_only=True)
+    with Transaction().start(database_name, user.id, readonly=True,
+            context=context):
+        partitions = partition_liquidations(
+            Liquidation.search(PENDING_DOMAIN))
+    return user.id, context, partitions
+
+
+def _post_partition(args):
+    database_name, user_id, context, key, ids = args
+    init_pool(database_name)
+    result = {
+        'company': key[0],
+        'sequence': key[1],
+        'posted': 0,
+        'error': None,
+        }
+    start = time.time()
+    Cache.clean(database_name)
+    with Transaction().start(database_name, user_id,
+            context=context) as transaction:
+        try:
+            result['posted'] = post_partition(ids)
+            transaction.cursor.commit()
+        except Exception as exception:
+            transaction.cursor.rollback()
+            logger.exception('Posting of partition %s failed', key)
+            result['posted'] = 0
+            result['error'] = unicode(exception)
+    Cache.resets(database_name)
+    result['seconds'] = time.time() - start
+    return result
+
+
+def post_pending(database_name, login='admin', processes=None):
+    '''
+    Post the pending liquidations of the database with processes workers
+
+    The calling process must not hold any database connection because the
+    workers are forked from it.
+    '''
+    if processes is None:
+        processes = config.getint('account_liquidation', 'post_processes',
+            default=1)
+    start = time.time()
+    workers = multiprocessing.Pool(processes)
+    try:
+        user_id, context, partitions = workers.apply(_get_partitions,
+            (database_name, login))
+        results = workers.map(_post_partition,
+            [(database_name, user_id, context, key, ids)
+                for key, ids in partitions], chunksize=1)
+    finally:
+        workers.close()
+        workers.join()
+    report = throughput_report(results, time.time() - start)
+    logger.info('Posted %s liquidations in %s partitions in %.2fs '
+        '(%.1f/s), %s failed', report['posted'], report['partitions'],
+        report['seconds'], report['per_second'], len(report['failed']))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Post pending purchase liquidations in parallel')
+    parser.add_argument('-c', '--config', dest='configfile', default=None)
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-u', '--user', dest='login', default='admin')
+    parser.add_argument('-p', '--processes', dest='processes', type=int,
+        default=None)
+    options = parser.parse_args()
+
+    config.update_etc(options.configfile)
+    logging.basicConfig(level=logging.INFO)
+    report = post_pending(options.database, options.login, options.processes)
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
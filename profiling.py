@@ -0,0 +1,195 @@
+#This file is part of the nodux_account_purchase_settlement module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''
+Profiling of the liquidation hot paths.
+
+Enabled with the profile option of the account_liquidation section of the
+configuration. Each stage records its wall time, the number of SQL queries
+and the rows they touched. The records are kept per transaction, logged and
+aggregated by duration bucket into account.liquidation.profile when the
+outermost stage ends.
+'''
+import logging
+import time
+from collections import defaultdict
+from functools import wraps
+from weakref import WeakKeyDictionary
+
+from sql import Literal
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['LiquidationProfile', 'stage', 'profiled', 'is_enabled']
+
+logger = logging.getLogger(__name__)
+
+_enabled = None
+# cursor -> _Records of the stages running in its transaction
+_transaction_records = WeakKeyDictionary()
+
+
+def is_enabled():
+    global _enabled
+    if _enabled is None:
+        _enabled = config.getboolean('account_liquidation', 'profile',
+            default=False)
+    return _enabled
+
+
+def _bucket(duration):
+    '''
+    Return the power of 2 milliseconds bucket of duration
+    '''
+    limit = 1
+    while duration * 1000 > limit and limit < 2 ** 16:
+        limit *= 2
+    return '<%sms' % limit if duration * 1000 <= limit else '>%sms' % limit
+
+
+class _Records(object):
+    '''
+    The stages recorded in a transaction and the depth of the running ones
+    '''
+
+    def __init__(self):
+        self.depth = 0
+        # (stage, bucket) -> [count, time, queries, rows]
+        self.records = defaultdict(lambda: [0, 0.0, 0, 0])
+
+
+class stage(object):
+    '''
+    Context manager that records a stage when profiling is enabled
+
+    The stages of a transaction are stored when its outermost stage ends
+    and dropped if it fails.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.rows = 0
+
+    def __enter__(self):
+        if not is_enabled():
+            return self
+        self.cursor = Transaction().cursor
+        self.records = _transaction_records.setdefault(self.cursor,
+            _Records())
+        self.records.depth += 1
+        self.execute = self.cursor.execute
+
+        def execute(*args, **kwargs):
+            result = self.execute(*args, **kwargs)
+            self.queries += 1
+            if self.cursor.rowcount and self.cursor.rowcount > 0:
+                self.rows += self.cursor.rowcount
+            return result
+        self.cursor.execute = execute
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if not is_enabled():
+            return
+        duration = time.time() - self.start
+        self.cursor.execute = self.execute
+        record = self.records.records[(self.name, _bucket(duration))]
+        record[0] += 1
+        record[1] += duration
+        record[2] += self.queries
+        record[3] += self.rows
+        logger.debug('%s: %.3fs, %s queries, %s rows', self.name, duration,
+            self.queries, self.rows)
+        self.records.depth -= 1
+        if not self.records.depth:
+            del _transaction_records[self.cursor]
+            if type is None:
+                _flush(dict(self.records.records))
+
+
+def profiled(name):
+    '''
+    Decorator that records the calls of the function as stage name
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _flush(records):
+    '''
+    Add the records to the profile histogram
+
+    They are stored in a new transaction which also works when the
+    profiled one is read-only.
+    '''
+    Profile = Pool().get('account.liquidation.profile')
+    with Transaction().new_cursor() as transaction:
+        try:
+            Profile.add(records)
+            transaction.cursor.commit()
+        except Exception:
+            transaction.cursor.rollback()
+            logger.warning('Unable to store the profile', exc_info=True)
+
+
+class LiquidationProfile(ModelSQL, ModelView):
+    'Purchase Liquidation Profile'
+    __name__ = 'account.liquidation.profile'
+    stage = fields.Char('Stage', required=True, readonly=True, select=True)
+    bucket = fields.Char('Duration', required=True, readonly=True)
+    count = fields.Integer('Count', readonly=True)
+    total_time = fields.Float('Total Time (s)', digits=(16, 3),
+        readonly=True)
+    queries = fields.Integer('Queries', readonly=True)
+    rows = fields.Integer('Rows', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(LiquidationProfile, cls).__setup__()
+        cls._order.insert(0, ('stage', 'ASC'))
+        cls._order.insert(1, ('total_time', 'DESC'))
+
+    @classmethod
+    def add(cls, records):
+        '''
+        Increment the histogram with records of
+        (stage, bucket): [count, time, queries, rows]
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        existing = dict(((p.stage, p.bucket), p.id) for p in cls.search([
+                    ('stage', 'in', list(set(s for s, _ in records))),
+                    ]))
+        to_create = []
+        for key, (count, time_, queries, rows) in records.items():
+            if key in existing:
+                cursor.execute(*table.update(
+                        columns=[table.count, table.total_time,
+                            table.queries, table.rows],
+                        values=[table.count + count,
+                            table.total_time + Literal(time_),
+                            table.queries + queries, table.rows + rows],
+                        where=table.id == existing[key]))
+            else:
+                to_create.append({
+                        'stage': key[0],
+                        'bucket': key[1],
+                        'count': count,
+                        'total_time': time_,
+                        'queries': queries,
+                        'rows': rows,
+                        })
+        if to_create:
+            cls.create(to_create)